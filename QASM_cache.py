@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # Windows, where eviction runs without the inter-process lock
+    fcntl = None
+
+
+class CircuitCache():
+    """
+    Persistent cache of compiled circuits, one .npz file of named arrays per entry in `directory`, keyed by
+    a content hash (see key).
+
+    Entries are written to a temporary file and moved in place with os.replace, so readers in other processes
+    only ever see complete entries. Reading an entry bumps its modification time, and whenever the cache grows
+    beyond `max_bytes` the least recently used entries are deleted under an exclusive lock on the directory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(content: str, version, **options):
+        ''' Hash of the QASM content, the compiler version and the options the compiled result depends on.'''
+        digest = hashlib.sha256()
+        digest.update(content.encode())
+        digest.update(json.dumps({'version': version, 'options': options}, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key: str):
+        ''' The arrays stored under key as a dict, or None if there is no such entry.'''
+        try:
+            with np.load(self.path(key), allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(self.path(key))
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # Missing, evicted meanwhile or unreadable (e.g. left by a crashed writer of an older version)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key: str, **arrays):
+        ''' Stores the arrays under key atomically, then evicts the least recently used entries if needed.'''
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(file, **arrays)
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.evict()
+
+    def entries(self):
+        ''' (modification time, size, path) of every entry, oldest first.'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for mtime, size, path in self.entries())
+
+    def evict(self):
+        ''' Deletes the least recently used entries until the cache fits in max_bytes.'''
+        if self.size() <= self.max_bytes:
+            return
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.entries()
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -1,24 +1,578 @@
-from time import time
+from time import perf_counter
 import numpy as np
 import functools as ft
+import itertools as it
+from concurrent.futures import ProcessPoolExecutor
 import random
+import os
+import tempfile
+import tracemalloc
+import json
+import re
+from fractions import Fraction
+from QASM_stabilizer import StabilizerTableau
+from QASM_sparse import SparseState
+from QASM_cache import CircuitCache
+
+"""
+==========================================================================================================
+                                        In-place Gate Kernels
+==========================================================================================================
+
+The kernels below act directly on a state vector of length 2**nq (or on a batch of them stacked along
+leading axes) through reshaped views, so no 2**nq x 2**nq operator is ever built. Qubit 0 is the most
+significant bit of the basis index, the same ordering as the kron products of the gate matrices.
+"""
+
+COMPILER_VERSION = 1 # Version of the compiled circuit format, bump it on any change so cached circuits are rebuilt
+BACKENDS = ('statevector', 'matrix', 'tableau', 'sparse')
+HISTORY = ('none', 'full', 'checkpoint', 'disk')
+DTYPES = ('complex64', 'complex128')
+SHOT_AMPLITUDES = 1 << 22 # Amplitudes per chunk of run_shots when no chunk size is given
+UNITARY_QUBITS = 10 # Widest register whose segment unitaries are built, a 2^10 x 2^10 matrix takes 16 MiB
+BLOCK = 1 << 16 # Number of elements per scratch block for the kernels that need temporary storage
+
+GATES = {
+    'h': (1/np.sqrt(2)) * np.array([[1, 1], [1, -1]], dtype=complex),
+    'x': np.array([[0, 1], [1, 0]], dtype=complex),
+    'y': np.array([[0, 0 - 1j], [0 + 1j, 0]], dtype=complex),
+    'z': np.array([[1, 0], [0, -1]], dtype=complex),
+    's': np.array([[1, 0], [0, 0 + 1j]], dtype=complex),
+}
+CLIFFORD = {'h', 's', 'x', 'y', 'z', 'cnot', 'cz', 'swap', 'nop', 'measure', 'c-x', 'c-z'}
+
+
+def new_scratch(dtype=complex, size: int = None):
+    ''' Allocates the pair of scratch blocks (of BLOCK elements by default) shared by all kernels of one simulation.'''
+    size = BLOCK if size is None else size
+    return np.empty(size, dtype=dtype), np.empty(size, dtype=dtype)
+
+
+def _temp_memmap(path, shape, dtype):
+    '''
+    A new memory-mapped array of zeros in the file at path, or if path is None in a temporary file that is
+    unlinked right away: the mapping keeps the data and its disk space is freed when the array is dropped.
+    '''
+    temporary = path is None
+    if temporary:
+        fd, path = tempfile.mkstemp(suffix='.state')
+        os.close(fd)
+    array = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    if temporary:
+        try:
+            os.unlink(path)
+        except OSError: # E.g. on Windows, where an open file cannot be removed
+            pass
+    return array
+
+
+def _reshape(psi, shape):
+    ''' Reshapes without ever copying, so that in-place updates always reach the original buffer.'''
+    view = psi.view()
+    view.shape = shape
+    return view
+
+
+def _blocks(shape, limit):
+    ''' Yields index tuples that cut an array of the given shape into blocks of at most `limit` elements.'''
+    inner = 1
+    axis = len(shape)
+    while axis > 0 and inner * shape[axis - 1] <= limit:
+        axis -= 1
+        inner *= shape[axis]
+    if axis == 0:
+        yield ()
+        return
+
+    step = max(1, limit // inner)
+    for outer in np.ndindex(*shape[:axis - 1]):
+        for start in range(0, shape[axis - 1], step):
+            yield outer + (slice(start, start + step),)
+
+
+def qubit_pair(psi, nq, qubit):
+    ''' Views of the amplitudes of psi with `qubit` in |0> and in |1>.'''
+    view = _reshape(psi, psi.shape[:-1] + (2**qubit, 2, 2**(nq - qubit - 1)))
+    return view[..., 0, :], view[..., 1, :]
+
+
+def controlled_pair(psi, nq, control, target):
+    ''' Views of the amplitudes of psi with `control` in |1> and `target` in |0> and in |1>.'''
+    lo, hi = min(control, target), max(control, target)
+    view = _reshape(psi, psi.shape[:-1] + (2**lo, 2, 2**(hi - lo - 1), 2, 2**(nq - hi - 1)))
+    if control < target:
+        return view[..., 1, :, 0, :], view[..., 1, :, 1, :]
+    return view[..., 0, :, 1, :], view[..., 1, :, 1, :]
+
+
+def swap_pair(psi, nq, a, b):
+    ''' Views of the amplitudes of psi with the qubits (a, b) in |01> and in |10>.'''
+    lo, hi = min(a, b), max(a, b)
+    view = _reshape(psi, psi.shape[:-1] + (2**lo, 2, 2**(hi - lo - 1), 2, 2**(nq - hi - 1)))
+    return view[..., 0, :, 1, :], view[..., 1, :, 0, :]
+
+
+def collapse(psi, nq, qubit, pick, prob):
+    ''' Projects psi in place onto `qubit` = pick, renormalizing by the probability prob of that outcome.'''
+    v0, v1 = qubit_pair(psi, nq, qubit)
+    (v1 if pick == 0 else v0)[...] = 0
+    (v0 if pick == 0 else v1)[...] *= 1/np.sqrt(prob)
+
+
+def norm2(v, scratch):
+    ''' Squared norm of an amplitude view, accumulated block by block.'''
+    total = 0.0
+    for idx in _blocks(v.shape, scratch[0].size):
+        block = v[idx]
+        t = scratch[0][:block.size].reshape(block.shape)
+        np.conjugate(block, out=t)
+        np.multiply(t, block, out=t)
+        total += t.real.sum()
+    return total
+
+
+def batch_norm2(v):
+    ''' Squared norm of every state of a batch of amplitude views, the batch running along the first axis.'''
+    axes = 'abcdefgh'[:v.ndim]
+    return np.einsum(f'{axes},{axes}->a', v.real, v.real) + np.einsum(f'{axes},{axes}->a', v.imag, v.imag)
+
+
+def run_shape(nq, qubits):
+    '''
+    Shape splitting a length 2^nq axis into one axis of size 2 per qubit of `qubits` (in increasing order)
+    and the runs of other qubits between them: (2^s1, 2, 2^(s2-s1-1), 2, ...), the qubit axes being the odd ones.
+    '''
+    shape, last = [], -1
+    for q in sorted(qubits):
+        shape += [2**(q - last - 1), 2]
+        last = q
+    shape.append(2**(nq - last - 1))
+    return shape
+
+
+def sum_out(values, nq, qubits):
+    ''' Sums a length 2^nq array over every qubit not in `qubits`, leaving one axis per qubit in increasing order.'''
+    shape = run_shape(nq, qubits)
+    return values.reshape(shape).sum(axis=tuple(range(0, len(shape), 2)))
+
+
+def marginal(psi, nq, qubits, block: int = None):
+    '''
+    Probabilities of all the joint outcomes of `qubits`, the first listed qubit being the most significant bit,
+    summed straight from the squared amplitudes of psi. With `block` psi is read in contiguous blocks of at most
+    that many amplitudes, so no temporary of its full size is made (e.g. for a memory-mapped state).
+    '''
+    if block is not None:
+        bits = min(nq, block.bit_length() - 1) # Blocks of 2^bits amplitudes share the qubits before nq - bits
+        high = nq - bits
+        lows = [q - high for q in qubits if q >= high]
+        result = np.zeros((2,) * len(qubits))
+        for c in range(2**high):
+            part = marginal(psi[c << bits:(c + 1) << bits], bits, lows)
+            result[tuple((c >> (high - 1 - q)) & 1 if q < high else slice(None) for q in qubits)] += \
+                part.reshape((2,) * len(lows))
+        return result.reshape(-1)
+
+    probs = psi.real**2
+    probs += psi.imag**2
+
+    selected = sorted(qubits)
+    return sum_out(probs, nq, selected).transpose([selected.index(q) for q in qubits]).reshape(-1)
+
+
+def _swap(v0, v1, scratch):
+    for idx in _blocks(v0.shape, scratch[0].size):
+        a, b = v0[idx], v1[idx]
+        t = scratch[0][:a.size].reshape(a.shape)
+        np.copyto(t, a)
+        np.copyto(a, b)
+        np.copyto(b, t)
+
+
+def apply_to_pair(gate, v0, v1, scratch):
+    ''' Applies a 2x2 gate, given by name or as a matrix, in place to the amplitude pair (v0, v1).'''
+    if isinstance(gate, str):
+        if gate == 'x':
+            _swap(v0, v1, scratch)
+        elif gate == 'y':
+            _swap(v0, v1, scratch)
+            v0 *= 0 - 1j
+            v1 *= 0 + 1j
+        elif gate == 'z':
+            v1 *= -1
+        elif gate == 's':
+            v1 *= 0 + 1j
+        elif gate == 'h':
+            v0 += v1 # a + b
+            v1 *= -2 # -2b
+            v1 += v0 # a - b
+            v0 *= 1/np.sqrt(2)
+            v1 *= 1/np.sqrt(2)
+        else:
+            apply_to_pair(GATES[gate], v0, v1, scratch)
+        return
+
+    u = gate
+    for idx in _blocks(v0.shape, scratch[0].size):
+        a, b = v0[idx], v1[idx]
+        t = scratch[0][:a.size].reshape(a.shape)
+        w = scratch[1][:a.size].reshape(a.shape)
+        np.copyto(t, a)
+        np.multiply(a, u[0, 0], out=a)
+        np.multiply(b, u[0, 1], out=w)
+        a += w
+        np.multiply(b, u[1, 1], out=b)
+        np.multiply(t, u[1, 0], out=w)
+        b += w
+
+
+def apply_to_block(matrix, psi, nq, first, scratch):
+    '''
+    Applies a 2^k x 2^k matrix to the k consecutive qubits starting at `first` in one pass over psi, multiplying
+    block by block through the scratch buffer.
+    '''
+    k = matrix.shape[0].bit_length() - 1
+    matrix = matrix.astype(psi.dtype, copy=False)
+    inner, rest = 2**k, 2**(nq - first - k)
+    view = _reshape(psi, (psi.size // (inner * rest), inner, rest))
+    buffer = scratch[0] if scratch[0].size >= inner else np.empty(inner, dtype=scratch[0].dtype)
+    limit = buffer.size
+
+    if inner * rest <= limit:
+        blocks = (np.s_[a:a + limit // (inner * rest)] for a in range(0, view.shape[0], limit // (inner * rest)))
+    else:
+        step = max(1, limit // inner)
+        blocks = (np.s_[a, :, b:b + step] for a in range(view.shape[0]) for b in range(0, rest, step))
+
+    for idx in blocks:
+        block = view[idx]
+        t = buffer[:block.size].reshape(block.shape)
+        np.matmul(matrix, block, out=t)
+        block[...] = t
+
+
+def _single(gate):
+    def kernel(psi, nq, control, target, scratch):
+        v0, v1 = qubit_pair(psi, nq, target)
+        apply_to_pair(gate, v0, v1, scratch)
+    return kernel
+
+
+def _controlled(gate):
+    def kernel(psi, nq, control, target, scratch):
+        v0, v1 = controlled_pair(psi, nq, control, target)
+        apply_to_pair(gate, v0, v1, scratch)
+    return kernel
+
+
+def _exchange(psi, nq, control, target, scratch):
+    v01, v10 = swap_pair(psi, nq, control, target)
+    _swap(v01, v10, scratch)
+
+
+def _idle(psi, nq, control, target, scratch):
+    return
+
+
+"""
+==========================================================================================================
+                                        Compiled Instructions
+==========================================================================================================
+
+A compiled circuit is an int8 opcode array plus an int32 (control, target) operand array, with -1 for a
+missing control. Opcodes below MEASURE are unitary and index the kernel table directly, the ones above it
+are classically controlled and apply the kernel given by CLASSICAL when their control bit was measured as 1.
+The optimizer may emit 'swap' and 'u', a fused 1-qubit gate whose control operand is the index of its
+2x2 matrix in the unitaries of the circuit; neither is accepted in QASM sources.
+"""
+
+OPCODES = ('nop', 'h', 's', 'x', 'y', 'z', 'cnot', 'cz', 'swap', 'u', 'measure', 'c-x', 'c-z')
+OPCODE = {name: code for code, name in enumerate(OPCODES)}
+MEASURE = OPCODE['measure']
+CLASSICAL = {OPCODE['c-x']: OPCODE['x'], OPCODE['c-z']: OPCODE['z']}
+INTERNAL = ('swap', 'u')
+ARITY = {'nop': (0, 1), 'cnot': (2,), 'cz': (2,), 'c-x': (2,), 'c-z': (2,)} # Number of qubits, 1 if not listed
+
+SINGLE = {OPCODE[name] for name in ('h', 's', 'x', 'y', 'z', 'u')}
+SELF_INVERSE = {OPCODE[name] for name in ('h', 'x', 'y', 'z', 'cnot', 'cz', 'swap')}
+SYMMETRIC = {OPCODE['cz'], OPCODE['swap']}
+AXES = { # Basis in which a gate acts on its (control, target): gates agreeing on all shared qubits commute
+    OPCODE['z']: (None, 'Z'), OPCODE['s']: (None, 'Z'), OPCODE['x']: (None, 'X'),
+    OPCODE['cnot']: ('Z', 'X'), OPCODE['cz']: ('Z', 'Z'),
+}
+OPTIMIZER_PASSES = ('drop_idles', 'cancel_inverses', 'fuse_single_qubit', 'merge_swaps')
+LAYER_QUBITS = 4 # Widest run of consecutive qubits whose 1-qubit gates in a moment are applied in one pass
+
+KERNELS = (_idle, _single('h'), _single('s'), _single('x'), _single('y'), _single('z'), _controlled('x'),
+           _controlled('z'), _exchange) # The kernel of 'u' is bound to the circuit, see kernel_table
+
+
+def wires(code, control, target):
+    ''' Qubits touched by a compiled instruction.'''
+    if code in SINGLE or code == MEASURE:
+        return (target,)
+    if code == OPCODE['nop']:
+        return (target,) if target >= 0 else ()
+    return (control, target)
+
+
+def parse_line(line):
+    ''' Parses one QASM line into [operation, qubit labels], e.g. ['cnot', '0,1'], or None if it holds none.'''
+    line = line.replace("\t", " ").split("#")[0].strip() # Remove comments and surrounding whitespace
+    if not line:
+        return None
+    words = line.split() # Take the first and last element of the white space separated words only
+    return [words[0], words[-1].replace('q', '')] # Remove the unecessary 'q' from the qubit labeling
+
+
+def compile_instruction(name, labels, nq, op):
+    ''' Validates one parsed operation of a register of nq qubits and returns its (opcode, control, target).'''
+    if name not in OPCODE or name in INTERNAL:
+        raise ValueError(f"Unknown operation '{name}' at time step {op}")
+    try:
+        qubits = [] if labels == name else [int(q) for q in labels.split(',')] # A lone 'nop' has no operands
+    except ValueError:
+        raise ValueError(f"Invalid qubit labels '{labels}' for '{name}' at time step {op}") from None
+
+    if len(qubits) not in ARITY.get(name, (1,)):
+        raise ValueError(f"Wrong number of qubits '{labels}' for '{name}' at time step {op}")
+    if any(q < 0 or q >= nq for q in qubits):
+        raise ValueError(f"Qubit out of range in '{labels}' for '{name}' at time step {op}, the register has {nq} qubits")
+    if name in ('cnot', 'cz') and qubits[0] == qubits[1]:
+        raise ValueError(f"Control and target of '{name}' coincide at time step {op}")
+
+    control, target = ([-1, -1] + qubits)[-2:]
+    return OPCODE[name], control, target
+
+
+DECLARE = -1 # Opcode yielded by stream_qasm for a qubit declaration
+
+
+def stream_qasm(filepath):
+    '''
+    Reads a QASM file lazily, yielding (-1, DECLARE, -1, qubit) for every qubit of the header and then one
+    validated (time step, opcode, control, target) per operation, so the file is never held in memory.
+    '''
+    nq = 0
+    t = 0
+    with open(filepath, 'r') as file:
+        for line in file:
+            parsed = parse_line(line)
+            if parsed is None:
+                continue
+            if parsed[0] == 'qubit':
+                if t:
+                    raise ValueError(f"Qubit declared after the first operation, at time step {t}")
+                yield -1, DECLARE, -1, nq
+                nq += 1
+            else:
+                yield (t,) + compile_instruction(parsed[0], parsed[1], nq, t)
+                t += 1
+
+
+def commutes(a, b):
+    ''' True if the compiled instructions a and b commute, judged on the qubits they share.'''
+    shared = set(wires(*a)) & set(wires(*b))
+    for qubit in shared:
+        axis_a = AXES.get(a[0], (None, None))[qubit == a[2]]
+        axis_b = AXES.get(b[0], (None, None))[qubit == b[2]]
+        if axis_a is None or axis_a != axis_b:
+            return False
+    return True
+
+
+"""
+==========================================================================================================
+                                        Pauli Observables
+==========================================================================================================
+
+A Pauli string is written either densely, one of I/X/Y/Z per qubit starting from qubit 0 (e.g. 'IZZ'), or
+sparsely as letters followed by qubit labels (e.g. 'Z1 Z2' or 'Zq1*Zq2'). Since Y = iXZ, the string acts on
+a basis state |j> as i^nY (-1)^(bits of j under Z or Y) |j with the bits under X or Y flipped>.
+"""
+
+
+def pauli_qubits(pauli: str, nq: int):
+    ''' The qubits under X or Y, the qubits under Z or Y and the number of Y of a Pauli string.'''
+    pauli = pauli.strip().upper()
+    if len(pauli) == nq and set(pauli) <= set('IXYZ'):
+        terms = [(letter, q) for q, letter in enumerate(pauli)]
+    else:
+        terms = [(letter, int(q)) for letter, q in re.findall(r'([IXYZ])Q?(\d+)', pauli)]
+        if not terms or re.sub(r'[IXYZ]Q?\d+|[\s*]', '', pauli):
+            raise ValueError(f"Invalid Pauli string '{pauli}' for {nq} qubits")
+
+    qubits = [q for letter, q in terms if letter != 'I']
+    if len(qubits) != len(set(qubits)) or any(q >= nq for q in qubits):
+        raise ValueError(f"Invalid Pauli string '{pauli}' for {nq} qubits")
+    flips = tuple(sorted(q for letter, q in terms if letter in 'XY'))
+    signs = tuple(sorted(q for letter, q in terms if letter in 'ZY'))
+    return flips, signs, sum(letter == 'Y' for letter, q in terms)
+
+
+def flipped_overlap(psi, nq, flips, partner=None):
+    ''' The array conj(partner[j with the bits of flips flipped]) * psi[j] over the basis indices j, partner being psi by default.'''
+    if not flips and partner is None:
+        overlap = psi.real**2
+        overlap += psi.imag**2
+        return overlap
+
+    shape = run_shape(nq, flips)
+    view = _reshape(psi, tuple(shape))
+    partner = view if partner is None else _reshape(partner, tuple(shape))
+    overlap = np.conjugate(np.flip(partner, axis=tuple(range(1, len(shape), 2))))
+    overlap *= view
+    return overlap.reshape(-1)
+
+
+def signed_sum(overlap, nq, signs):
+    '''
+    Sum of an overlap array with the sign (-1)^(bits of j on the qubits of signs), folding the halves of the
+    most significant qubit onto each other down to the last sign qubit, then summing what is left.
+    '''
+    folded = overlap
+    for q in range(max(signs, default=-1) + 1):
+        halves = folded.reshape(2, -1)
+        folded = halves[0] - halves[1] if q in signs else halves[0] + halves[1]
+    return complex(folded.sum())
+
+
+def blocked_pauli_sum(psi, nq, flips, signs, block: int):
+    '''
+    Sum of conj(psi[j with the bits of flips flipped]) psi[j] (-1)^(bits of j on signs) reading psi in contiguous
+    blocks of at most `block` amplitudes: the flips and signs on the qubits before nq - bits pick the partner
+    block and the sign of a whole block, the others are applied within the blocks.
+    '''
+    bits = min(nq, block.bit_length() - 1)
+    high = nq - bits
+    x_mask = sum(1 << (high - 1 - q) for q in flips if q < high)
+    z_mask = sum(1 << (high - 1 - q) for q in signs if q < high)
+    low_flips = tuple(q - high for q in flips if q >= high)
+    low_signs = tuple(q - high for q in signs if q >= high)
+
+    total = 0j
+    for c in range(2**high):
+        chunk = psi[c << bits:(c + 1) << bits]
+        partner = psi[(c ^ x_mask) << bits:((c ^ x_mask) + 1) << bits]
+        overlap = flipped_overlap(chunk, bits, low_flips, partner)
+        total += (-1)**bin(c & z_mask).count('1') * signed_sum(overlap, bits, low_signs)
+    return total
+
 
 class QASM_compiler():
     """
     QASM Compiler class for creating and simulating quantum circuits from QASM language.
+
+    The `backend` selects the simulation engine: 'statevector' applies every gate in place on the state
+    vector, 'matrix' multiplies the state with the full 2^n x 2^n operator of every gate and 'tableau' runs
+    Clifford circuits on a stabilizer tableau in polynomial time (falling back to 'statevector' otherwise),
+    keeping the history 'none' only.
+    'sparse' keeps only the nonzero amplitudes keyed by basis index, which suits circuits with little
+    superposition on any number of qubits, and turns dense once more than `sparse_fill` of the 2^n amplitudes
+    are stored; it keeps the history 'none' or 'full' only.
+
+    The `history` policy sets which states of a run are kept in `state`: 'none' only the current one, 'full'
+    a copy after every time step, 'checkpoint' the initial state and a copy every `checkpoint_every` steps
+    (the others are recomputed by state_at) and 'disk' every state in the memory-mapped `history_file`
+    (if not given a temporary file, removed as soon as it is mapped) with only the current one in memory.
+
+    With `stream` the file is not loaded up front: circuit_simulate reads, validates and executes it line by
+    line on the 'statevector' backend, so QASM files of any length run in constant parser memory; the methods
+    needing the whole program (depth, run_shots, exact_distribution, ...) raise a ValueError then. Without a
+    file (`file_p` None) the compiler is empty until a compiled circuit is loaded, see from_program.
+
+    With `layered` the 'statevector' backend executes the circuit moment by moment (see schedule), applying the
+    1-qubit gates of every moment on runs of up to LAYER_QUBITS neighbouring qubits in a single pass over the
+    state; only the last state is kept. While hooks or profiling are active the gates are not fused, so
+    every instruction is reported on its own.
+
+    The `dtype` of the amplitudes is 'complex128' or 'complex64', which halves the memory of every state at
+    single precision. With `out_of_core` the state vector of the 'statevector' and 'sparse' backends lives in a
+    memory-mapped `state_file` (a temporary file if not given, unlinked right away so its space is freed with
+    the state) and every kernel streams through it in blocks sized from `memory_budget` bytes, so registers
+    larger than the RAM run at sequential I/O speed. marginal_probabilities, sample and expectations stream
+    through it the same way, while run_shots on a state vector, run_batch and exact_distribution, which hold
+    several full states, raise a ValueError; it keeps the history 'none' or 'disk' only.
+
+    With a `cache` (a CircuitCache or its directory) the compiled circuit is looked up by the hash of the file
+    content before parsing, and stored there after compiling, so unchanged files are never parsed twice.
+
+    With `profile` every simulation aggregates the wall time, calls and allocated bytes per opcode, see
+    enable_profiling; hooks added with add_hook are called around every executed instruction.
     """
 
-    def __init__(self, file_p: str):
+    def __init__(self, file_p: str, backend: str = 'statevector', optimize: bool = False, history: str = 'none',
+                 checkpoint_every: int = 64, history_file: str = None, stream: bool = False, profile: bool = False,
+                 layered: bool = False, sparse_fill: float = 1/16, cache=None, dtype: str = 'complex128',
+                 out_of_core: bool = False, memory_budget: int = 64 * 2**20, state_file: str = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', choose one of {BACKENDS}")
+        if history not in HISTORY:
+            raise ValueError(f"Unknown history policy '{history}', choose one of {HISTORY}")
+        if stream and (backend != 'statevector' or history in ('checkpoint', 'disk') or optimize):
+            raise ValueError("Streaming runs on the 'statevector' backend with history 'none' or 'full', unoptimized")
+        if backend == 'sparse' and history not in ('none', 'full'):
+            raise ValueError("The 'sparse' backend keeps the history 'none' or 'full' only")
+        if backend == 'tableau' and history != 'none':
+            raise ValueError("The 'tableau' backend keeps the history 'none' only")
+        if checkpoint_every < 1:
+            raise ValueError(f"checkpoint_every must be at least 1, got {checkpoint_every}")
+        if np.dtype(dtype).name not in DTYPES:
+            raise ValueError(f"Unsupported dtype '{dtype}', choose one of {DTYPES}")
+        if out_of_core and (backend not in ('statevector', 'sparse') or history not in ('none', 'disk')):
+            raise ValueError("Out-of-core runs on the 'statevector' or 'sparse' backend with history 'none' or 'disk'")
+        if layered and (backend != 'statevector' or history != 'none' or stream):
+            raise ValueError("Layered execution runs on the 'statevector' backend with history 'none', not streamed")
         self.qasmfile = file_p
+        self.backend = backend
+        self.history = history
+        self.checkpoint_every = checkpoint_every
+        self.history_file = history_file
+        self.snapshots = None # Memory-mapped states of the last run with history 'disk'
         self.time: int
         self.nq: int
         self.state = {}
+        self.outcomes = {} # Measurement outcome of every measure time step of the last run
+        self.fired = set() # Time steps of the c-x/c-z of the last run that were applied
+        self._current_state = None
         self.measurements = {}
         self.probabilities = {}
+        self.stream = stream
+        self.layered = layered
+        self.sparse_fill = sparse_fill
+        self.dtype = np.dtype(dtype)
+        self.out_of_core = out_of_core
+        self.memory_budget = memory_budget
+        self.state_file = state_file
+        self.hooks = []
+        self.profile = None # Statistics per opcode name while profiling, None when disabled
+        self.stats = {} # Statistics frozen by the last disable_profiling
+        if profile:
+            self.enable_profiling()
+        self.cache = CircuitCache(cache) if isinstance(cache, str) else cache
+        self.segment_unitaries = {} # Unitaries of the unitary segments built so far, by cache key
+        if stream or file_p is None:
+            self.unitaries = []
+            if stream:
+                self.nq = self.time = 0 # Known once circuit_simulate has read the file
+            return
 
         self.qasm_read(self.qasmfile)
+        if self.cache is not None:
+            key = CircuitCache.key(''.join(self.read_circuit), COMPILER_VERSION, optimize=optimize,
+                                   backend=backend)
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.restore(entry)
+                return
+
         self.parse_operations()
         self.initialize_register()
+        self.compile_circuit()
+        if optimize:
+            self.optimize()
+        if self.cache is not None:
+            self.cache.put(key, **self.cache_entry())
 
     """
     ==========================================================================================================
@@ -34,30 +588,30 @@ class QASM_compiler():
         return
     
     def parse_operations(self):
-        ''' Cleans up the strings line by line and parses to the computable form.'''
-        for op in range(len(self.read_circuit)):
-            self.read_circuit[op] = self.read_circuit[op].replace("\t", " ")
-            self.read_circuit[op] = self.read_circuit[op].strip("\n") # Remove leading and trailing new line characters
-            self.read_circuit[op] = self.read_circuit[op].split("#")[0] # Remove comments by splitting and selecting the first part
-            self.read_circuit[op] = self.read_circuit[op].strip() # Remove all leading whitespaces
-
-        self.read_circuit.remove("") # Remove all empty strings from the last version
-
-        for op in range(len(self.read_circuit)):
-            self.read_circuit[op] = self.read_circuit[op].split(" ") #Split with all white spaces between the string and take first and last element only
-            self.read_circuit[op] = [self.read_circuit[op][0], self.read_circuit[op][-1]]
-
-        for op in range(len(self.read_circuit)):
-            if self.read_circuit[op] == ['', '']:
-                self.read_circuit[op] = 'XXX'
-
-        while 'XXX' in self.read_circuit:
-            self.read_circuit.remove('XXX')
+        ''' Cleans up the strings line by line and parses to the computable form, in a single pass.'''
+        parsed = (parse_line(line) for line in self.read_circuit)
+        self.read_circuit = [op for op in parsed if op is not None] # Drop empty and comment lines
 
         self.time = len(self.read_circuit) # Number of time stamps for the quantum circuit
 
-        for op in range(len(self.read_circuit)):
-            self.read_circuit[op][-1] = self.read_circuit[op][-1].replace('q', '') # Remove the unecessary 'q' from the qubit labeling
+    def cache_entry(self):
+        ''' The compiled circuit as named arrays for the cache.'''
+        return {'nq': np.array(self.nq), 'opcodes': self.opcodes, 'qargs': self.qargs,
+                'unitaries': np.array(self.unitaries, dtype=complex).reshape(-1, 2, 2),
+                'read_circuit': np.array(self.read_circuit, dtype=str).reshape(-1, 2),
+                'optimization_report': np.array(json.dumps(getattr(self, 'optimization_report', None)))}
+
+    def restore(self, entry):
+        ''' Loads a compiled circuit from the arrays of a cache entry, in place of parsing and compiling.'''
+        self.nq = int(entry['nq'])
+        self.read_circuit = entry['read_circuit'].tolist()
+        self.time = len(self.read_circuit)
+        self.opcodes = entry['opcodes']
+        self.qargs = entry['qargs']
+        self.unitaries = list(entry['unitaries'])
+        report = json.loads(str(entry['optimization_report']))
+        if report is not None:
+            self.optimization_report = report
 
     """
     ==========================================================================================================
@@ -207,6 +761,222 @@ class QASM_compiler():
 
         return s_n
 
+    def SWAP(self, qubit_a, qubit_b):
+        return np.matmul(self.CNOT(qubit_a, qubit_b), np.matmul(self.CNOT(qubit_b, qubit_a), self.CNOT(qubit_a, qubit_b)))
+
+    def U(self, matrix, qubit):
+        id = np.identity(2)
+        un = list(range(self.nq))
+        
+        for i in list(range(self.nq)):
+            if i == qubit:
+                un[i] = matrix
+            else:
+                un[i] = id
+       
+        u_n = ft.reduce(lambda x, y: np.kron(x, y), un)
+
+        return u_n
+
+    """
+    ==========================================================================================================
+                                            Moment Scheduling
+    ==========================================================================================================
+    
+    """
+
+    def schedule(self, alap: bool = False):
+        '''
+        Packs the compiled circuit into moments of operations on disjoint qubits, each one as early as possible,
+        or with `alap` as late as possible. A c-x/c-z holds the wire of its control qubit, so it always follows
+        the measurement setting its classical bit and precedes any later measurement of that qubit. A nop
+        without qubits goes in the first (last with `alap`) moment.
+
+        Returns the moments as lists of (time step, opcode, control, target) in program order.
+        '''
+        program = self.program()
+        layers = [0] * len(program)
+        level = [0] * self.nq # First free moment of every wire, counted from the end with `alap`
+
+        for i in reversed(range(len(program))) if alap else range(len(program)):
+            t, code, control, target = program[i]
+            qubits = wires(code, control, target)
+            layers[i] = max((level[q] for q in qubits), default=0)
+            for q in qubits:
+                level[q] = layers[i] + 1
+
+        depth = max(level, default=0) or min(len(program), 1)
+        moments = [[] for _ in range(depth)]
+        for i, layer in enumerate(layers):
+            moments[depth - 1 - layer if alap else layer].append(program[i])
+        return moments
+
+    def depth(self):
+        ''' Number of moments of the compiled circuit, its run time when operations on disjoint qubits run in parallel.'''
+        return len(self.schedule())
+
+    def layer_plan(self, fuse: bool = True):
+        '''
+        The moments of the circuit as lists of steps for layered_simulate. The 1-qubit gates of a moment are
+        grouped into runs of at most LAYER_QUBITS neighbouring qubits and every run of two or more gates
+        becomes one ('block', first qubit, kron product) step; the other operations stay instructions. Without
+        `fuse` every step is an instruction, in the order of the moments.
+        '''
+        plan = []
+        for moment in self.schedule():
+            if not fuse:
+                plan.append(sorted(moment, key=lambda ins: ins[1] not in SINGLE))
+                continue
+            steps, run = [], []
+            singles = sorted((ins for ins in moment if ins[1] in SINGLE), key=lambda ins: ins[3])
+            for ins in singles + [None]:
+                if ins is not None and (not run or ins[3] - run[0][3] < LAYER_QUBITS):
+                    run.append(ins)
+                    continue
+                if len(run) == 1:
+                    steps.append(run[0])
+                elif run:
+                    gates = {target: self.gate_matrix(code, control) for t, code, control, target in run}
+                    first, last = run[0][3], run[-1][3]
+                    matrix = ft.reduce(np.kron, [gates.get(q, np.eye(2)) for q in range(first, last + 1)])
+                    steps.append(('block', first, matrix))
+                run = [ins]
+
+            steps += [ins for ins in moment if ins[1] not in SINGLE]
+            plan.append(steps)
+        return plan
+
+    def gate_matrix(self, code, control):
+        ''' 2x2 matrix of a compiled 1-qubit gate.'''
+        return self.unitaries[control] if code == OPCODE['u'] else GATES[OPCODES[code]]
+
+    """
+    ==========================================================================================================
+                                            Circuit Optimization
+    ==========================================================================================================
+    
+    """
+
+    def optimize(self, passes=OPTIMIZER_PASSES):
+        '''
+        Runs the optimization passes in order on the compiled circuit. Returns, and keeps as
+        optimization_report, the gate count and depth before and after every pass.
+        '''
+        report = []
+        for name in passes:
+            if name == 'fuse_single_qubit' and self.backend == 'tableau':
+                continue # Fused gates are not Clifford in general and would force the state vector fallback
+
+            gates, depth = len(self.opcodes), self.depth()
+            program = [[code, control, target] for t, code, control, target in self.program()]
+            self.load_program(getattr(self, name)(program))
+            report.append({'pass': name, 'gates_before': gates, 'gates_after': len(self.opcodes),
+                           'depth_before': depth, 'depth_after': self.depth()})
+
+        self.optimization_report = report
+        return report
+
+    def drop_idles(self, program):
+        ''' Removes every nop.'''
+        return [ins for ins in program if ins[0] != OPCODE['nop']]
+
+    def cancel_inverses(self, program):
+        ''' Removes pairs of equal self-inverse gates that only have commuting operations between them.'''
+        out = []
+        on_wire = [[] for _ in range(self.nq)] # Indices in out of the instructions touching every qubit
+
+        def same(a, b):
+            return a[0] == b[0] and (a[1:] == b[1:] or (a[0] in SYMMETRIC and a[1:] == b[:0:-1]))
+
+        def cancel(ins, qubits):
+            for j in reversed(on_wire[qubits[0]]):
+                if out[j] is None:
+                    continue
+                if same(out[j], ins):
+                    later = [out[k] for q in qubits[1:] for k in on_wire[q] if k > j and out[k] is not None]
+                    if all(commutes(other, ins) for other in later):
+                        out[j] = None
+                        return True
+                    return False
+                if not commutes(out[j], ins):
+                    return False
+            return False
+
+        for ins in program:
+            qubits = wires(*ins)
+            if ins[0] in SELF_INVERSE and cancel(ins, qubits):
+                continue
+            for q in qubits:
+                on_wire[q].append(len(out))
+            out.append(ins)
+
+        return [ins for ins in out if ins is not None]
+
+    def fuse_single_qubit(self, program):
+        '''
+        Fuses every run of 1-qubit gates on a wire into one gate. A run multiplying to the identity is dropped
+        and one multiplying to a named gate becomes that gate, the others become 'u' gates.
+        '''
+        out = []
+        runs = [None] * self.nq # [index in out, matrix, gate count] of the open run on every qubit
+
+        def close(qubit):
+            if runs[qubit] is None:
+                return
+            j, matrix, count = runs[qubit]
+            runs[qubit] = None
+            if count == 1:
+                return
+            if np.allclose(matrix, np.identity(2)):
+                out[j] = None
+                return
+            for name in ('h', 's', 'x', 'y', 'z'):
+                if np.allclose(matrix, GATES[name]):
+                    out[j] = [OPCODE[name], -1, qubit]
+                    return
+            self.unitaries.append(matrix)
+            out[j] = [OPCODE['u'], len(self.unitaries) - 1, qubit]
+
+        for ins in program:
+            code, control, target = ins
+            if code in SINGLE:
+                matrix = self.unitaries[control] if code == OPCODE['u'] else GATES[OPCODES[code]]
+                if runs[target] is not None:
+                    runs[target][1] = np.matmul(matrix, runs[target][1])
+                    runs[target][2] += 1
+                    continue
+                runs[target] = [len(out), matrix, 1]
+            else:
+                for q in wires(*ins):
+                    close(q)
+            out.append(ins)
+
+        for q in range(self.nq):
+            close(q)
+        return [ins for ins in out if ins is not None]
+
+    def merge_swaps(self, program):
+        ''' Replaces three alternating cnots on the same pair of qubits, which amount to a swap, by a swap.'''
+        out = []
+        on_wire = [[] for _ in range(self.nq)]
+        cnot = OPCODE['cnot']
+
+        for ins in program:
+            code, control, target = ins
+            if code == cnot:
+                a, b = on_wire[control][-2:], on_wire[target][-2:]
+                if len(a) == 2 and a == b and out[a[0]] == ins and out[a[1]] == [cnot, target, control]:
+                    out[a[0]] = [OPCODE['swap'], min(control, target), max(control, target)]
+                    out[a[1]] = None
+                    on_wire[control].pop()
+                    on_wire[target].pop()
+                    continue
+            for q in wires(*ins):
+                on_wire[q].append(len(out))
+            out.append(ins)
+
+        return [ins for ins in out if ins is not None]
+
     """
     ==========================================================================================================
                                             Circuit Simulation functions
@@ -215,13 +985,76 @@ class QASM_compiler():
     """ 
     @property
     def current_state(self):
-        return self.current_state
+        return self._current_state
 
-    @current_state.setter
-    def current_state(self):
-        self.current_state = self.state[self.state.keys()[-1]]
-        return self.current_state
+    def start_history(self, psi):
+        ''' Resets the history for a new run starting from psi.'''
+        self.state = {}
+        self.outcomes = {}
+        self.fired = set()
+        if self.history == 'disk':
+            self.snapshots = _temp_memmap(self.history_file, (len(self.opcodes) + 1, psi.size), self.dtype)
+        self.record(-1, psi)
+
+    def record(self, t, psi):
+        ''' Keeps the state after time step t according to the history policy and makes it the current state.'''
+        self._current_state = psi
+        if self.history == 'full':
+            self.state[f't{t}'] = psi.copy()
+        elif self.history == 'checkpoint':
+            if (t + 1) % self.checkpoint_every == 0:
+                self.state[f't{t}'] = psi.copy()
+        else:
+            self.state = {f't{t}': psi}
+            if self.history == 'disk':
+                self.snapshots[t + 1] = psi
+
+    def state_at(self, t: int):
+        ''' The state after time step t (-1 for the initial state) of the last run, recomputed if not kept.'''
+        if self.history == 'disk':
+            return np.array(self.snapshots[t + 1])
+        if f't{t}' in self.state:
+            return self.state[f't{t}']
+        if self.history != 'checkpoint':
+            raise KeyError(f"The state at time step {t} is not kept with history='{self.history}'")
+
+        start = (t + 1) // self.checkpoint_every * self.checkpoint_every - 1
+        psi = self.state[f't{start}'].astype(self.dtype) # Copy of the last checkpoint before t
+        scratch = new_scratch(psi.dtype)
+        kernels = self.kernel_table()
+
+        for step, code, control, target in self.program()[start + 1:t + 1]:
+            if code < MEASURE:
+                kernels[code](psi, self.nq, control, target, scratch)
+            elif code == MEASURE:
+                pick = self.outcomes[step]
+                collapse(psi, self.nq, target, pick, norm2(qubit_pair(psi, self.nq, target)[pick], scratch))
+            elif step in self.fired:
+                kernels[CLASSICAL[code]](psi, self.nq, control, target, scratch)
+        return psi
      
+    def new_state(self):
+        '''
+        The state vector |0...0> of a new run: in memory, or with `out_of_core` in a memory-mapped file whose
+        pages the kernels stream through, see new_kernel_scratch.
+        '''
+        if not self.out_of_core:
+            psi = np.zeros(2**self.nq, dtype=self.dtype)
+        else:
+            psi = _temp_memmap(self.state_file, (2**self.nq,), self.dtype)
+        psi[0] = 1
+        return psi
+
+    def new_kernel_scratch(self):
+        ''' Scratch blocks for the kernels: BLOCK elements, or out of core a quarter of the memory budget each.'''
+        if not self.out_of_core:
+            return new_scratch(self.dtype)
+        return new_scratch(self.dtype, self.block_amplitudes())
+
+    def block_amplitudes(self):
+        ''' Amplitudes per block streamed through out of core, a quarter of the memory budget.'''
+        return max(1, self.memory_budget // (4 * self.dtype.itemsize))
+
     def initialize_register(self):
         qubits = 0
         for op in range(len(self.read_circuit)):
@@ -234,50 +1067,253 @@ class QASM_compiler():
         return
 
 
-    def circuit_simulate(self):
-        self.state['t-1'] = np.zeros(2**self.nq)
-        self.state['t-1'][0] = 1
+    def compile_circuit(self):
+        ''' Compiles read_circuit once into the opcode and operand arrays, validating every operation.'''
+        self.opcodes = np.zeros(len(self.read_circuit), dtype=np.int8)
+        self.qargs = np.full((len(self.read_circuit), 2), -1, dtype=np.int32)
+        self.unitaries = []
 
         for op in range(len(self.read_circuit)):
-            if self.read_circuit[op][0] == 'nop':
-                self.state[f't{op}'] = np.matmul(self.idle(), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'cnot':
-                control = int(list(self.read_circuit[op][1])[0])
-                target = int(list(self.read_circuit[op][1])[-1])
-                self.state[f't{op}'] = np.matmul(self.CNOT(control, target), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'cz':
-                control = int(list(self.read_circuit[op][1])[0])
-                target = int(list(self.read_circuit[op][1])[-1])
-                self.state[f't{op}'] = np.matmul(self.CZ(control, target), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'h':
-                self.state[f't{op}'] = np.matmul(self.H(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 's':
-                self.state[f't{op}'] = np.matmul(self.S(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'x':
-                self.state[f't{op}'] = np.matmul(self.X(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'y':
-                self.state[f't{op}'] = np.matmul(self.Y(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'z':
-                self.state[f't{op}'] = np.matmul(self.Z(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-            elif self.read_circuit[op][0] == 'measure':
-                _temp_msr = self.measure(int(list(self.read_circuit[op][1])[-1]), op)
-            elif self.read_circuit[op][0] == 'c-x':
-                control = int(list(self.read_circuit[op][1])[0])
-                target = int(list(self.read_circuit[op][1])[-1])
-                if self.measurements[f'q{control}'] == 1:
-                    self.state[f't{op}'] = np.matmul(self.X(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-                else:
-                    self.state[f't{op}'] = self.state[f't{op-1}']
-            elif self.read_circuit[op][0] == 'c-z':
-                control = int(list(self.read_circuit[op][1])[0])
-                target = int(list(self.read_circuit[op][1])[-1]) 
-                if self.measurements[f'q{control}'] == 1:
-                    self.state[f't{op}'] = np.matmul(self.Z(int(list(self.read_circuit[op][1])[-1])), self.state[f't{op-1}'])
-                else:
-                    self.state[f't{op}'] = self.state[f't{op-1}']
+            name, labels = self.read_circuit[op]
+            self.opcodes[op], self.qargs[op, 0], self.qargs[op, 1] = compile_instruction(name, labels, self.nq, op)
+
+    def program(self):
+        ''' The compiled circuit as (time step, opcode, control, target) tuples of plain ints.'''
+        self.require_program()
+        return [(t, code, control, target) for t, (code, (control, target))
+                in enumerate(zip(self.opcodes.tolist(), self.qargs.tolist()))]
+
+    def require_program(self):
+        ''' Raises a ValueError in streaming mode, where the operations are executed as they are read and never kept.'''
+        if self.stream:
+            raise ValueError("The compiled program is not available in streaming mode, only circuit_simulate runs the circuit")
+
+    def require_in_memory(self, what: str):
+        ''' Raises a ValueError out of core for the methods holding several full state vectors in memory.'''
+        if self.out_of_core:
+            raise ValueError(f"{what} holds several full state vectors in memory and is not available out of core")
+
+    @classmethod
+    def from_program(cls, nq: int, program, unitaries=(), **options):
+        ''' Builds a compiler around a list of [opcode, control, target] instructions, without any QASM file.'''
+        circuit = cls(None, **options)
+        circuit.nq = nq
+        circuit.time = len(program)
+        circuit.unitaries = list(unitaries)
+        circuit.load_program(program)
+        return circuit
+
+    def load_program(self, program):
+        ''' Replaces the compiled circuit by a list of [opcode, control, target] instructions.'''
+        self.opcodes = np.array([ins[0] for ins in program], dtype=np.int8)
+        self.qargs = np.array([ins[1:] for ins in program], dtype=np.int32).reshape(-1, 2)
+
+    def kernel_table(self):
+        ''' The in-place kernels indexed by opcode, with the one of 'u' bound to the unitaries of this circuit.'''
+        def fused(psi, nq, control, target, scratch):
+            v0, v1 = qubit_pair(psi, nq, target)
+            apply_to_pair(self.unitaries[control], v0, v1, scratch)
+        return KERNELS + (fused,)
+
+    def is_clifford(self):
+        ''' True if every operation of the circuit can be simulated on a stabilizer tableau.'''
+        self.require_program()
+        return all(OPCODES[code] in CLIFFORD for code in np.unique(self.opcodes))
+
+    def circuit_simulate(self):
+        if self.stream:
+            self.stream_simulate()
+        elif self.backend == 'matrix':
+            self.matrix_simulate()
+        elif self.backend == 'tableau' and self.is_clifford():
+            self.tableau_simulate()
+        elif self.backend == 'sparse':
+            self.sparse_simulate()
+        elif self.layered:
+            self.layered_simulate()
+        else:
+            self.statevector_simulate()
+
+    def tableau_simulate(self):
+        '''
+        Runs a Clifford circuit on a stabilizer tableau. Only the final tableau is kept in the state history,
+        since intermediate tableaus of large registers would dominate the memory.
+        '''
+        tableau = self.tableau = StabilizerTableau(self.nq)
+        self.outcomes = {}
+        sample = lambda weights: random.choices([0, 1], weights)[0]
+        gates = (lambda c, q: None, lambda c, q: tableau.H(q), lambda c, q: tableau.S(q), lambda c, q: tableau.X(q),
+                 lambda c, q: tableau.Y(q), lambda c, q: tableau.Z(q), tableau.CNOT, tableau.CZ, tableau.SWAP)
+
+        for t, code, control, target in self.instructions(self.program()):
+            if code < MEASURE:
+                gates[code](control, target)
+            elif code == MEASURE:
+                pick, prob = tableau.measure(target, sample)
+                self.probabilities[f'q{target}'] = prob
+                self.measurements[f'q{target}'] = pick
+                self.outcomes[t] = pick
+            elif self.measurements[f'q{control}'] == 1:
+                gates[CLASSICAL[code]](control, target)
+
+        self.state = {f't{len(self.opcodes) - 1}': tableau}
+        self._current_state = tableau
 
+    def sparse_simulate(self):
+        '''
+        Runs the circuit on a SparseState while it stores at most `sparse_fill` of the 2^n amplitudes, then
+        carries on in place on the dense state vector.
+        '''
+        state = SparseState(self.nq)
+        self.start_history(state)
+        sample = lambda weights: random.choices([0, 1], weights)[0]
+        gates = (lambda c, q: None, lambda c, q: state.H(q), lambda c, q: state.S(q), lambda c, q: state.X(q),
+                 lambda c, q: state.Y(q), lambda c, q: state.Z(q), state.CNOT, state.CZ, state.SWAP,
+                 lambda c, q: state.U(self.unitaries[c], q))
+        # Kept in integer arithmetic, as 2^n overflows a float from 1024 qubits on
+        fill = Fraction(self.sparse_fill)
+        limit = lambda count: count * fill.denominator > fill.numerator * 2**self.nq
+        kernels = self.kernel_table()
+        self.psi = None
+
+        for t, code, control, target in self.instructions(self.program()):
+            if self.psi is not None:
+                if code < MEASURE:
+                    kernels[code](self.psi, self.nq, control, target, self.scratch)
+                elif code == MEASURE:
+                    self.measure(target, t)
+                    continue
+                elif self.measurements[f'q{control}'] == 1:
+                    kernels[CLASSICAL[code]](self.psi, self.nq, control, target, self.scratch)
+                    self.fired.add(t)
+                self.record(t, self.psi)
+                continue
+
+            if code < MEASURE:
+                gates[code](control, target)
+            elif code == MEASURE:
+                pick, prob = state.measure(target, sample)
+                self.probabilities[f'q{target}'] = prob
+                self.measurements[f'q{target}'] = pick
+                self.outcomes[t] = pick
+            elif self.measurements[f'q{control}'] == 1:
+                gates[CLASSICAL[code]](control, target)
+                self.fired.add(t)
+
+            if limit(len(state.amps)):
+                self.psi = state.to_dense(out=self.new_state())
+                self.scratch = self.new_kernel_scratch()
+                self.record(t, self.psi)
+            else:
+                self.record(t, state)
+
+    def stream_simulate(self):
+        '''
+        Declares the register from the qubit header of the file, then executes the operations as they are read;
+        nq and time are set along the way.
+        '''
+        stream = stream_qasm(self.qasmfile)
+        self.nq = self.time = 0
+        first = []
+        for instruction in stream:
+            if instruction[1] != DECLARE:
+                first = [instruction]
+                break
+            self.nq += 1
+
+        def counted(instructions):
+            for instruction in instructions:
+                self.time = instruction[0] + 1
+                yield instruction
+        self.statevector_simulate(counted(it.chain(first, stream)))
+
+    def statevector_simulate(self, program=None):
+        '''
+        Runs the circuit, or an iterable of (time step, opcode, control, target) instructions, with every gate
+        applied in place on a single state vector.
+        '''
+        self.psi = self.new_state()
+        self.scratch = self.new_kernel_scratch()
+        self.start_history(self.psi)
+        kernels = self.kernel_table()
+
+        for t, code, control, target in self.instructions(self.program() if program is None else program):
+            if code < MEASURE:
+                kernels[code](self.psi, self.nq, control, target, self.scratch)
+            elif code == MEASURE:
+                _temp_msr = self.measure(target, t)
+                continue
+            elif self.measurements[f'q{control}'] == 1:
+                kernels[CLASSICAL[code]](self.psi, self.nq, control, target, self.scratch)
+                self.fired.add(t)
+            self.record(t, self.psi)
+
+    def layered_simulate(self):
+        ''' Runs the circuit moment by moment on a single state vector, see layer_plan.'''
+        self.psi = self.new_state()
+        self.scratch = self.new_kernel_scratch()
+        self.start_history(self.psi)
+        kernels = self.kernel_table()
+
+        # Hooks and the profiler see every instruction on its own, so nothing is fused while one is active
+        fuse = not self.hooks and self.profile is None
+        for step in self.instructions([step for steps in self.layer_plan(fuse) for step in steps]):
+            if step[0] == 'block':
+                apply_to_block(step[2], self.psi, self.nq, step[1], self.scratch)
+                continue
+            t, code, control, target = step
+            if code < MEASURE:
+                kernels[code](self.psi, self.nq, control, target, self.scratch)
+            elif code == MEASURE:
+                self.measure(target, t)
+            elif self.measurements[f'q{control}'] == 1:
+                kernels[CLASSICAL[code]](self.psi, self.nq, control, target, self.scratch)
+                self.fired.add(t)
+        self.record(len(self.opcodes) - 1, self.psi)
+
+    def matrix_simulate(self):
+        ''' Runs the circuit by multiplying the state with the full operator of every gate.'''
+        initial = np.zeros(2**self.nq, dtype=self.dtype)
+        initial[0] = 1
+        self.start_history(initial)
+
+        operators = (lambda c, q: self.idle(), lambda c, q: self.H(q), lambda c, q: self.S(q), lambda c, q: self.X(q),
+                     lambda c, q: self.Y(q), lambda c, q: self.Z(q), self.CNOT, self.CZ, self.SWAP,
+                     lambda c, q: self.U(self.unitaries[c], q))
+
+        for t, code, control, target in self.instructions(self.program()):
+            if code < MEASURE:
+                self.record(t, self.matrix_apply(operators[code](control, target)))
+            elif code == MEASURE:
+                _temp_msr = self.measure(target, t)
+            elif self.measurements[f'q{control}'] == 1:
+                self.record(t, self.matrix_apply(operators[CLASSICAL[code]](control, target)))
+                self.fired.add(t)
+            else:
+                self.record(t, self.current_state)
+
+
+    def matrix_apply(self, operator):
+        ''' The current state multiplied by a full operator, kept in the dtype of the compiler.'''
+        return np.matmul(operator, self.current_state).astype(self.dtype, copy=False)
 
     def measure(self, qubit, time):
+        if self.backend == 'matrix':
+            return self.matrix_measure(qubit, time)
+
+        v0, v1 = qubit_pair(self.psi, self.nq, qubit)
+        weights = [norm2(v0, self.scratch), norm2(v1, self.scratch)]
+        pick = random.choices([0, 1], weights)[0]
+        collapse(self.psi, self.nq, qubit, pick, weights[pick])
+
+        self.probabilities[f'q{qubit}'] = weights[pick]
+        self.measurements[f'q{qubit}'] = pick
+        self.outcomes[time] = pick
+        self.record(time, self.psi)
+
+        return pick
+
+    def matrix_measure(self, qubit, time):
         ele0 = np.array([[1, 0], [0, 0]])
         ele1 = np.array([[0, 0], [0, 1]])
         id = np.identity(2)
@@ -296,153 +1332,592 @@ class QASM_compiler():
         ele0_n = ft.reduce(lambda x, y: np.kron(x, y), ele0n)
         ele1_n = ft.reduce(lambda x, y: np.kron(x, y), ele1n)
 
-        prob_0 = np.dot(self.state[list(self.state.keys())[-1]], np.matmul(ele0_n, self.state[list(self.state.keys())[-1]]))
-        prob_1 = np.dot(self.state[list(self.state.keys())[-1]], np.matmul(ele1_n, self.state[list(self.state.keys())[-1]]))
+        prob_0 = np.vdot(self.current_state, np.matmul(ele0_n, self.current_state)).real
+        prob_1 = np.vdot(self.current_state, np.matmul(ele1_n, self.current_state)).real
         weights = [prob_0, prob_1]
 
-        pick = int((random.choices([0, 1]), weights)[0][0])
+        pick = random.choices([0, 1], weights)[0]
 
         if pick == 0:
-            post_measure = np.matmul(ele0_n,self.state[list(self.state.keys())[-1]])
+            post_measure = np.matmul(ele0_n,self.current_state)
         elif pick == 1:
-            post_measure = np.matmul(ele1_n,self.state[list(self.state.keys())[-1]])
+            post_measure = np.matmul(ele1_n,self.current_state)
 
-        post_measure_normalized = post_measure / np.linalg.norm(post_measure)
+        post_measure_normalized = (post_measure / np.linalg.norm(post_measure)).astype(self.dtype, copy=False)
 
         self.probabilities[f'q{qubit}'] = weights[pick]
         self.measurements[f'q{qubit}'] = pick
-        self.state[f't{time}'] = post_measure_normalized
+        self.outcomes[time] = pick
+        self.record(time, post_measure_normalized)
 
         return pick
 
-    def visualize(self):
-        # print(self.read_circuit,self.nq)
-        with open('circuit.txt','w') as wr:
+    """
+    ==========================================================================================================
+                                            Instrumentation
+    ==========================================================================================================
+    
+    """
+
+    def add_hook(self, hook):
+        '''
+        Registers hook(event, instruction, elapsed) to be called around every instruction the simulation executes:
+        with event 'before' (elapsed None) and 'after' (elapsed the wall time in seconds). The instruction is the
+        (time step, opcode, control, target) tuple.
+        '''
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def enable_profiling(self, memory: bool = False):
+        '''
+        Starts aggregating the wall time and the number of calls per opcode over the next simulations. With
+        `memory` tracemalloc is started too and the peak bytes allocated while executing each instruction are
+        added up as well (tracing slows the simulation down noticeably).
+        '''
+        self.profile = {}
+        self.profile_memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable_profiling(self):
+        ''' Stops the profiling, the statistics gathered so far are kept in profile_stats.'''
+        if self.profile is not None and self.profile_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.profile_memory = False
+        self.stats = self.profile_stats()
+        self.profile = None
+
+    def instructions(self, program):
+        ''' The instructions of a run, wrapped in the hooks and the profiler only when one of them is active.'''
+        if not self.hooks and self.profile is None:
+            return program
+        return self.instrumented(program)
+
+    def instrumented(self, program):
+        '''
+        Yields the instructions of program one by one; the caller executes each one before asking for the next,
+        so the time between two yields is the cost of the instruction.
+        '''
+        profile = self.profile
+        memory = profile is not None and self.profile_memory and tracemalloc.is_tracing()
+
+        for instruction in program:
+            for hook in self.hooks:
+                hook('before', instruction, None)
+            if memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+
+            start = perf_counter()
+            yield instruction
+            elapsed = perf_counter() - start
+
+            if profile is not None:
+                entry = profile.setdefault(OPCODES[instruction[1]], {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+                entry['calls'] += 1
+                entry['seconds'] += elapsed
+                if memory:
+                    entry['bytes'] += tracemalloc.get_traced_memory()[1] - baseline
+            for hook in self.hooks:
+                hook('after', instruction, elapsed)
+
+    def state_bytes(self):
+        ''' Memory held by the current state, a state vector, a sparse state or a tableau.'''
+        state = self.current_state
+        if isinstance(state, StabilizerTableau):
+            return state.x.nbytes + state.z.nbytes + state.r.nbytes
+        return 0 if state is None else state.nbytes
+
+    def history_bytes(self):
+        ''' Memory held by the `state` history, states shared with the current one counted once.'''
+        seen = {id(self.current_state)}
+        total = 0
+        for state in self.state.values():
+            if id(state) not in seen and isinstance(state, np.ndarray):
+                seen.add(id(state))
+                total += state.nbytes
+        return total
+
+    def profile_stats(self):
+        '''
+        The statistics of the profiled runs: per opcode the calls, total and mean seconds and allocated bytes
+        (hottest first), plus the size of the current state and of the history.
+        '''
+        profile = self.profile if self.profile is not None else self.stats.get('opcodes', {})
+        opcodes = {}
+        for name, entry in sorted(profile.items(), key=lambda item: -item[1]['seconds']):
+            opcodes[name] = dict(entry, mean_seconds=entry['seconds'] / entry['calls'])
+
+        stats = {'opcodes': opcodes,
+                 'total_seconds': sum(entry['seconds'] for entry in opcodes.values()),
+                 'total_calls': sum(entry['calls'] for entry in opcodes.values()),
+                 'state_bytes': self.state_bytes(),
+                 'history_entries': len(self.state),
+                 'history_bytes': self.history_bytes()}
+        if self.history == 'disk' and self.snapshots is not None:
+            stats['history_disk_bytes'] = self.snapshots.nbytes
+        return stats
+
+    def profile_report(self):
+        ''' The profile statistics as a printable table.'''
+        stats = self.profile_stats()
+        lines = [f"{'opcode':>8} {'calls':>10} {'seconds':>12} {'mean (us)':>12} {'share':>7} {'bytes':>12}"]
+        for name, entry in stats['opcodes'].items():
+            share = entry['seconds'] / stats['total_seconds'] if stats['total_seconds'] else 0.0
+            lines.append(f"{name:>8} {entry['calls']:>10} {entry['seconds']:>12.6f} {1e6 * entry['mean_seconds']:>12.2f} "
+                         f"{share:>7.1%} {entry['bytes']:>12}")
+        lines.append(f"{'total':>8} {stats['total_calls']:>10} {stats['total_seconds']:>12.6f}")
+        lines.append(f"State: {stats['state_bytes']} bytes, history: {stats['history_entries']} states "
+                     f"holding {stats['history_bytes']} more bytes")
+        if 'history_disk_bytes' in stats:
+            lines.append(f"History on disk: {stats['history_disk_bytes']} bytes in {self.history_file or 'a temporary file'}")
+        return '\n'.join(lines)
+
+    def profile_json(self, filepath: str = None):
+        ''' The profile statistics as JSON, also written to filepath if given.'''
+        text = json.dumps(self.profile_stats(), indent=2)
+        if filepath is not None:
+            with open(filepath, 'w') as file:
+                file.write(text)
+        return text
+
+    """
+    ==========================================================================================================
+                                            Pauli Expectation Values
+    ==========================================================================================================
+    
+    """
+
+    def expectation(self, pauli: str):
+        ''' Exact expectation value of a Pauli string in the current state, see expectations.'''
+        return self.expectations([pauli])[0]
+
+    def expectations(self, paulis):
+        '''
+        Exact expectation values <psi|P|psi> of many Pauli strings in the current state, simulating the circuit
+        first if it was not run yet (with measurements the state is the one of that particular run). No
+        operator is built: the overlap of psi with its bit-flipped copy is computed once per set of flipped
+        qubits and reduced with the signs of every string, or summed over the entries of a sparse state. On a
+        stabilizer tableau every value is 0 or +-1, read from the stabilizer group (see StabilizerTableau
+        expectation). Out of core every string is summed block by block over the memory-mapped state instead.
+        '''
+        if self.current_state is None:
+            self.circuit_simulate()
+        terms = [pauli_qubits(pauli, self.nq) for pauli in paulis]
+        values = np.zeros(len(terms))
+
+        if isinstance(self.current_state, StabilizerTableau):
+            for k, (flips, signs, ny) in enumerate(terms):
+                values[k] = self.current_state.expectation(flips, signs)
+            return values
+
+        if isinstance(self.current_state, SparseState):
+            for k, (flips, signs, ny) in enumerate(terms):
+                x_mask = sum(self.current_state.bit(q) for q in flips)
+                z_mask = sum(self.current_state.bit(q) for q in signs)
+                values[k] = ((1j)**ny * self.current_state.expectation(x_mask, z_mask)).real
+            return values
+
+        psi = self.state_vector()
+        if self.out_of_core:
+            for k, (flips, signs, ny) in enumerate(terms):
+                values[k] = ((1j)**ny * blocked_pauli_sum(psi, self.nq, flips, signs, self.block_amplitudes())).real
+            return values
+
+        for flips in set(flips for flips, signs, ny in terms):
+            overlap = flipped_overlap(psi, self.nq, flips)
+            for k, (term_flips, signs, ny) in enumerate(terms):
+                if term_flips == flips:
+                    values[k] = ((1j)**ny * signed_sum(overlap, self.nq, signs)).real
+        return values
+
+    """
+    ==========================================================================================================
+                                            Probabilities and Sampling
+    ==========================================================================================================
+    
+    """
+
+    def state_vector(self):
+        ''' The current state of the last run as a state vector, expanding a sparse one (out of core into a memory map).'''
+        if isinstance(self.current_state, SparseState):
+            return self.current_state.to_dense(self.dtype, self.new_state() if self.out_of_core else None)
+        if not isinstance(self.current_state, np.ndarray):
+            raise ValueError("No state vector available, run circuit_simulate on a state vector backend first")
+        return self.current_state
+
+    def marginal_probabilities(self, qubits=None):
+        '''
+        Probabilities of all the joint outcomes of `qubits` (all the qubits by default) in the current state,
+        indexed by the outcome bitstring read as an integer with the first listed qubit most significant.
+        '''
+        qubits = list(range(self.nq)) if qubits is None else list(qubits)
+        if any(not 0 <= q < self.nq for q in qubits):
+            raise ValueError(f"Qubit out of range in {qubits} for the marginal probabilities, the register has {self.nq} qubits")
+        if len(set(qubits)) != len(qubits):
+            raise ValueError(f"Repeated qubit in {qubits} for the marginal probabilities")
+        return marginal(self.state_vector(), self.nq, qubits, self.block_amplitudes() if self.out_of_core else None)
+
+    def sample(self, shots: int, qubits=None, seed=None):
+        '''
+        Draws `shots` measurement outcomes of `qubits` (all the qubits by default) from the current state in one
+        vectorized call, by inverting the cumulative distribution with searchsorted. The state is not collapsed.
+
+        Returns a dict like run_shots: the qubit labels ('qubits'), the (shots, qubits) outcomes ('records') and
+        the counts of every bitstring ('counts').
+        '''
+        qubits = list(range(self.nq)) if qubits is None else list(qubits)
+        cdf = np.cumsum(self.marginal_probabilities(qubits))
+        rng = np.random.default_rng(seed)
+        outcomes = np.searchsorted(cdf, rng.random(shots) * cdf[-1], side='right')
+        outcomes = np.minimum(outcomes, cdf.size - 1) # Guards against rounding at the very top of the cdf
+
+        bits = np.arange(len(qubits) - 1, -1, -1)
+        records = ((outcomes[:, None] >> bits) & 1).astype(np.int8)
+        frequency = np.bincount(outcomes, minlength=cdf.size)
+        counts = {format(i, f'0{len(qubits)}b'): int(frequency[i]) for i in np.flatnonzero(frequency)}
+
+        return {'qubits': [f'q{q}' for q in qubits], 'records': records, 'counts': counts}
+
+    """
+    ==========================================================================================================
+                                            Multi-shot Execution
+    ==========================================================================================================
+    
+    """
+
+    def run_shots(self, shots: int, seed=None, workers: int = 1, chunk_size: int = None):
+        '''
+        Runs the shots of the circuit in chunks of `chunk_size` trajectories, each chunk carried as one
+        (chunk, 2^n) array of state vectors: every gate is applied once to the whole chunk, measurements are
+        sampled per row and c-x/c-z are applied only to the rows whose control was measured as 1.
+
+        Every chunk draws from its own numpy Generator spawned from `seed`, and with `workers` > 1 the chunks
+        are spread over a process pool that receives the compiled circuit once per worker. The records only
+        depend on the seed and the chunk size, never on the number of workers.
+
+        On the 'tableau' (Clifford circuits) and 'sparse' backends, which never hold the 2^n amplitudes, the
+        shots are run one at a time by trajectory_records instead, and `workers` and `chunk_size` are unused.
+
+        Returns a dict with the labels of the measured qubits in measurement order ('qubits'), the per-shot
+        outcomes as a (shots, measurements) array ('records') and the counts of every bitstring ('counts').
+        '''
+        qubits = [f'q{target}' for t, code, control, target in self.program() if code == MEASURE]
+        if self.backend == 'sparse' or self.backend == 'tableau' and self.is_clifford():
+            records = self.trajectory_records(shots, seed)
+        else:
+            self.require_in_memory("run_shots on a state vector backend")
+            if chunk_size is None:
+                chunk_size = max(1, min(4096, SHOT_AMPLITUDES // 2**self.nq))
+            sizes = [min(chunk_size, shots - start) for start in range(0, shots, chunk_size)]
+            seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+            if workers > 1 and len(sizes) > 1:
+                program = [[code, control, target] for t, code, control, target in self.program()]
+                with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker,
+                                         initargs=(self.nq, program, self.unitaries, self.dtype.name)) as pool:
+                    chunks = list(pool.map(_run_chunk, zip(sizes, seeds)))
+            else:
+                chunks = [self.run_batch(size, np.random.default_rng(child)) for size, child in zip(sizes, seeds)]
+            records = np.concatenate(chunks) if chunks else np.zeros((0, len(qubits)), dtype=np.int8)
+
+        outcomes, frequency = np.unique(records, axis=0, return_counts=True)
+        counts = {''.join(map(str, row)): int(count) for row, count in zip(outcomes, frequency)}
+
+        return {'qubits': qubits, 'records': records, 'counts': counts}
+
+    def trajectory_records(self, shots: int, seed=None):
+        '''
+        Measurement records of `shots` runs of circuit_simulate, drawn from the random module seeded with `seed`
+        (its previous state is restored afterwards) so the records only depend on the seed.
+        '''
+        times = [t for t, code, control, target in self.program() if code == MEASURE]
+        records = np.zeros((shots, len(times)), dtype=np.int8)
+        saved = random.getstate()
+        random.seed(seed)
+        try:
+            for shot in range(shots):
+                self.circuit_simulate()
+                records[shot] = [self.outcomes[t] for t in times]
+        finally:
+            random.setstate(saved)
+        return records
+
+    def run_batch(self, shots: int, rng, psi=None, fused: bool = False):
+        '''
+        Runs `shots` trajectories together, from |0...0> or from the rows of psi (updated in place), sampling
+        from the Generator rng; with `fused` every unitary segment is one product with its unitary, see
+        fused_program. Returns their measurement records.
+        '''
+        self.require_in_memory("run_batch")
+        if psi is None:
+            psi = np.zeros((shots, 2**self.nq), dtype=self.dtype)
+            psi[:, 0] = 1
+        scratch = new_scratch(psi.dtype)
+        creg = np.zeros((shots, self.nq), dtype=np.int8) # Last outcome of every qubit, per shot
+        records = []
+        kernels = self.kernel_table()
+
+        for step in self.fused_program() if fused else self.program():
+            if isinstance(step, np.ndarray):
+                psi[...] = psi @ step.T # Every row psi[k] becomes U psi[k]
+                continue
+
+            t, code, control, target = step
+            if code < MEASURE:
+                kernels[code](psi, self.nq, control, target, scratch)
+            elif code == MEASURE:
+                v0, v1 = qubit_pair(psi, self.nq, target)
+                prob_1 = np.clip(batch_norm2(v1), 0, 1)
+                pick = (rng.random(shots) < prob_1).astype(np.int8)
+
+                scale = np.sqrt(np.where(pick == 1, prob_1, 1 - prob_1))
+                scale = np.divide(1, scale, out=np.zeros_like(scale), where=scale > 0)
+                v0 *= np.where(pick == 0, scale, 0).reshape(-1, 1, 1)
+                v1 *= np.where(pick == 1, scale, 0).reshape(-1, 1, 1)
+
+                creg[:, target] = pick
+                records.append(pick)
+            else:
+                rows = np.flatnonzero(creg[:, control] == 1)
+                if rows.size:
+                    masked = psi[rows]
+                    kernels[CLASSICAL[code]](masked, self.nq, control, target, scratch)
+                    psi[rows] = masked
+
+        return np.stack(records, axis=1) if records else np.zeros((shots, 0), dtype=np.int8)
+
+    """
+    ==========================================================================================================
+                                            Circuit Unitaries
+    ==========================================================================================================
+    
+    """
+
+    def segments(self):
+        ''' The compiled circuit cut at every measure and c-x/c-z: lists of unitary instructions and the cuts alone.'''
+        segments, run = [], []
+        for ins in self.program():
+            if ins[1] < MEASURE:
+                run.append(ins)
+                continue
+            if run:
+                segments.append(run)
+                run = []
+            segments.append(ins)
+        return segments + [run] if run else segments
+
+    def segment_unitary(self, segment):
+        '''
+        Unitary of a list of unitary instructions, built once by applying them to the rows of the identity.
+        It is kept in memory and in the cache of the compiler, keyed by the instructions (and fused matrices).
+        '''
+        if self.nq > UNITARY_QUBITS:
+            raise ValueError(f"Circuit unitaries are limited to {UNITARY_QUBITS} qubits, the circuit has {self.nq}")
+        content = json.dumps([ins[1:] for ins in segment]) + ''.join(
+            np.asarray(self.unitaries[control]).tobytes().hex() for t, code, control, target in segment
+            if code == OPCODE['u'])
+        key = CircuitCache.key(content, COMPILER_VERSION, nq=self.nq, dtype=self.dtype.name, kind='segment_unitary')
+        if key in self.segment_unitaries:
+            return self.segment_unitaries[key]
+
+        entry = self.cache.get(key) if self.cache is not None else None
+        if entry is not None:
+            unitary = entry['unitary']
+        else:
+            rows = np.eye(2**self.nq, dtype=self.dtype)
+            scratch = new_scratch(rows.dtype)
+            kernels = self.kernel_table()
+            for t, code, control, target in segment:
+                kernels[code](rows, self.nq, control, target, scratch)
+            unitary = np.ascontiguousarray(rows.T) # Row j holds U|j>, which is the column j of U
+            if self.cache is not None:
+                self.cache.put(key, unitary=unitary)
+
+        self.segment_unitaries[key] = unitary
+        return unitary
+
+    def fused_program(self):
+        ''' The segments of the circuit with every unitary one replaced by its 2^n x 2^n unitary.'''
+        return [self.segment_unitary(step) if isinstance(step, list) else step for step in self.segments()]
+
+    def circuit_unitary(self):
+        ''' The unitary of the whole circuit, which must have no measure or c-x/c-z.'''
+        self.require_program()
+        if any(code >= MEASURE for code in self.opcodes.tolist()):
+            raise ValueError("The circuit measures, use evolve to run it on a batch of states segment by segment")
+        return self.segment_unitary(self.program())
+
+    def evolve(self, states, seed=None):
+        '''
+        Runs the circuit on a (2^n, K) batch of normalized input states, one per column. Each unitary segment
+        is applied to the whole batch in one matrix product with its cached unitary; measurements are sampled
+        per column from a Generator seeded with `seed` and c-x/c-z applied to the columns that measured 1.
+
+        Returns a dict with the (2^n, K) output states ('states'), the labels of the measured qubits in
+        measurement order ('qubits') and the per-column outcomes as a (K, measurements) array ('records').
+        '''
+        states = np.asarray(states)
+        if states.ndim != 2 or states.shape[0] != 2**self.nq:
+            raise ValueError(f"Expected a (2^{self.nq}, K) batch of states, got the shape {states.shape}")
+
+        psi = np.array(states.T, dtype=self.dtype, order='C') # One state per row, as the kernels expect
+        records = self.run_batch(psi.shape[0], np.random.default_rng(seed), psi=psi, fused=True)
+        qubits = [f'q{target}' for t, code, control, target in self.program() if code == MEASURE]
+
+        return {'states': psi.T, 'qubits': qubits, 'records': records}
+
+    """
+    ==========================================================================================================
+                                            Exact Outcome Distribution
+    ==========================================================================================================
+    
+    """
+
+    def exact_distribution(self, tolerance: float = 1e-12):
+        '''
+        Computes the exact distribution of the measurement records in one deterministic pass. Every measure
+        forks each branch into its two post-measurement states, dropping outcomes with probability at most
+        `tolerance`. Branches with the same state and the same classical bits still needed by later c-x/c-z
+        are merged, so they are evolved only once.
+
+        Returns a dict with the labels of the measured qubits in measurement order ('qubits'), the probability
+        of every record bitstring ('distribution') and the final state of every record ('states').
+        '''
+        self.require_in_memory("exact_distribution")
+        psi = np.zeros(2**self.nq, dtype=self.dtype)
+        psi[0] = 1
+        scratch = new_scratch(psi.dtype)
+        kernels = self.kernel_table()
+
+        # Classical controls still to be read after every time step, the only bits that tell branches apart
+        program = self.program()
+        pending = [set() for _ in range(len(program) + 1)]
+        for t, code, control, target in reversed(program):
+            pending[t] = set(pending[t + 1])
+            if code in CLASSICAL:
+                pending[t].add(control)
+
+        # Every branch is [state, classical register, {record: probability}]
+        branches = [[psi, np.zeros(self.nq, dtype=np.int8), {(): 1.0}]]
+        qubits = []
+
+        for t, code, control, target in program:
+            if code < MEASURE:
+                for psi, creg, records in branches:
+                    kernels[code](psi, self.nq, control, target, scratch)
+            elif code == MEASURE:
+                forked = []
+                for psi, creg, records in branches:
+                    v0, v1 = qubit_pair(psi, self.nq, target)
+                    weights = [norm2(v0, scratch), norm2(v1, scratch)]
+                    for pick in (0, 1):
+                        if weights[pick] <= tolerance:
+                            continue
+                        post = psi.copy()
+                        collapse(post, self.nq, target, pick, weights[pick])
+
+                        post_creg = creg.copy()
+                        post_creg[target] = pick
+                        post_records = {record + (pick,): prob * weights[pick] for record, prob in records.items()}
+                        forked.append([post, post_creg, post_records])
+                branches = self.merge_branches(forked, pending[t + 1])
+                qubits.append(f'q{target}')
+            else:
+                for psi, creg, records in branches:
+                    if creg[control] == 1:
+                        kernels[CLASSICAL[code]](psi, self.nq, control, target, scratch)
+                branches = self.merge_branches(branches, pending[t + 1])
+
+        distribution, states = {}, {}
+        for psi, creg, records in branches:
+            for record, prob in records.items():
+                bits = ''.join(map(str, record))
+                distribution[bits] = float(prob)
+                states[bits] = psi
+
+        return {'qubits': qubits, 'distribution': distribution, 'states': states}
+
+    def merge_branches(self, branches, controls):
+        ''' Merges the branches whose states agree and whose classical bits in `controls` agree.'''
+        controls = sorted(controls)
+        merged = {}
+        for psi, creg, records in branches:
+            key = (creg[controls].tobytes(), (np.round(psi, 10) + 0).tobytes()) # + 0 turns -0.0 into 0.0
+            if key in merged:
+                merged[key][2].update(records)
+            else:
+                merged[key] = [psi, creg, records]
+        return list(merged.values())
+
+    def visualize(self, per_moment: bool = True, filepath: str = 'circuit.txt'):
+        '''
+        Writes the circuit as a quantikz environment, one column per moment (split further where vertical
+        connections of a moment would cross) or with `per_moment` False one column per operation.
+        '''
+        columns = []
+        for moment in self.schedule() if per_moment else [[ins] for ins in self.program()]:
+            packed = [] # Columns of the moment with their covered qubit span
+            for ins in moment:
+                qubits = wires(*ins[1:]) or (0,)
+                span = (min(qubits), max(qubits))
+                for column, spans in packed:
+                    if all(span[1] < lo or span[0] > hi for lo, hi in spans):
+                        column.append(ins)
+                        spans.append(span)
+                        break
+                else:
+                    packed.append(([ins], [span]))
+            columns += [column for column, spans in packed]
+
+        with open(filepath, 'w') as wr:
             wr.write("\\begin{quantikz}")
             for i in range(self.nq):
                 wr.write("\n")
                 wr.write("\\lstick{$\ket{0}$}")
-                for l in range(len(self.read_circuit)):
-                    if l == len(self.read_circuit)-1:
-                        if self.read_circuit[l][0] == 'h':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{H}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'x':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{X}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'y':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{Y}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'z':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{Z}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 's':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{S}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'cnot':
-                            if self.read_circuit[l][1][0] == str(i):
-                                lines_down = int(self.read_circuit[l][1][-1])
-                                lines_down = lines_down - i 
-                                wr.write(" & \\ctrl{%s}" % (int(lines_down)))
-                            elif self.read_circuit[l][1][-1] == str(i):
-                                wr.write(" & \\targ{}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'measure':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\meter{}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'c-x':
-                            if self.read_circuit[l][1][0] == str(i):
-                                lines_down = int(self.read_circuit[l][1][-1])
-                                lines_down = lines_down - i 
-                                wr.write(" & \\ctrl{%s}" % (int(lines_down)))
-                            elif self.read_circuit[l][1][-1] == str(i):
-                                wr.write(" & \\gate{c-x}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'c-z':
-                            if self.read_circuit[l][1][0] == str(i):
-                                lines_down = int(self.read_circuit[l][1][-1])
-                                lines_down = lines_down - i 
-                                wr.write(" & \\ctrl{%s}" % (int(lines_down)))
-                            elif self.read_circuit[l][1][-1] == str(i):
-                                wr.write(" & \\gate{c-z}")
-                            else:
-                                wr.write(" & \\qw")
-                        else:
-                            wr.write(" & \\qw")
-                        wr.write(" \\\\")
-                    else:
-                        if self.read_circuit[l][0] == 'h':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{H}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'x':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{X}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'y':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{Y}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'z':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{Z}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 's':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\gate{S}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'cnot':
-                            if self.read_circuit[l][1][0] == str(i):
-                                lines_down = int(self.read_circuit[l][1][-1])
-                                lines_down = lines_down - i 
-                                wr.write(" & \\ctrl{%s}" % (int(lines_down)))
-                            elif self.read_circuit[l][1][-1] == str(i):
-                                wr.write(" & \\targ{}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'measure':
-                            if self.read_circuit[l][1] == str(i):
-                                wr.write(" & \\meter{}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'c-x':
-                            if self.read_circuit[l][1][0] == str(i):
-                                lines_down = int(self.read_circuit[l][1][-1])
-                                lines_down = lines_down - i 
-                                wr.write(" & \\ctrl{%s}" % (int(lines_down)))
-                            elif self.read_circuit[l][1][-1] == str(i):
-                                wr.write(" & \\gate{c-x}")
-                            else:
-                                wr.write(" & \\qw")
-                        elif self.read_circuit[l][0] == 'c-z':
-                            if self.read_circuit[l][1][0] == str(i):
-                                lines_down = int(self.read_circuit[l][1][-1])
-                                lines_down = lines_down - i 
-                                wr.write(" & \\ctrl{%s}" % (int(lines_down)))
-                            elif self.read_circuit[l][1][-1] == str(i):
-                                wr.write(" & \\gate{c-z}")
-                            else:
-                                wr.write(" & \\qw")
-                        else:
-                            wr.write(" & \\qw")
+                for column in columns:
+                    cells = [quantikz_cell(code, control, target, i) for t, code, control, target in column]
+                    wr.write(next((cell for cell in cells if cell is not None), " & \\qw"))
+                wr.write(" \\\\")
             wr.write("\n")
-            wr.write("\\end{quantikz}")
\ No newline at end of file
+            wr.write("\\end{quantikz}")
+
+
+def quantikz_cell(code, control, target, qubit):
+    ''' The quantikz cell of a compiled instruction on the wire of `qubit`, None if it does not touch it.'''
+    name = OPCODES[code]
+    if qubit not in wires(code, control, target):
+        return None
+    if name == 'measure':
+        return " & \\meter{}"
+    if code in SINGLE:
+        return " & \\gate{%s}" % ('U' if name == 'u' else name.upper())
+    if name == 'nop':
+        return " & \\qw"
+    if name == 'swap':
+        return " & \\swap{%s}" % (target - control) if qubit == control else " & \\targX{}"
+    if qubit == control:
+        return " & \\ctrl{%s}" % (target - control)
+    return {'cnot': " & \\targ{}", 'cz': " & \\control{}"}.get(name, " & \\gate{%s}" % name)
+
+
+"""
+==========================================================================================================
+                                        Process Pool Workers
+==========================================================================================================
+
+"""
+
+_worker_circuit = None # Circuit of the current worker process, received once through the pool initializer
+
+
+def _start_worker(nq, program, unitaries, dtype):
+    global _worker_circuit
+    _worker_circuit = QASM_compiler.from_program(nq, program, unitaries, dtype=dtype)
+
+
+def _run_chunk(chunk):
+    shots, seed = chunk
+    return _worker_circuit.run_batch(shots, np.random.default_rng(seed))
@@ -0,0 +1,131 @@
+import sys
+import numpy as np
+
+TOLERANCE = 1e-14 # Amplitudes below this magnitude after an interference are dropped
+
+
+class SparseState():
+    """
+    State of an n-qubit register holding only its nonzero amplitudes, in a dict from the basis index (a
+    Python int, so any number of qubits fits) to the amplitude. Qubit q is the bit nq-1-q of the index, the
+    same ordering as the dense state vector.
+
+    Permutation gates (x, y, cnot, swap) only remap the indices and phase gates (z, s, cz) only scale the
+    amplitudes, so both keep the number of entries; h and general 2x2 gates may double it.
+    """
+
+    def __init__(self, nq: int):
+        self.nq = nq
+        self.amps = {0: 1 + 0j}
+
+    def bit(self, qubit):
+        return 1 << (self.nq - 1 - qubit)
+
+    def copy(self):
+        state = SparseState(self.nq)
+        state.amps = dict(self.amps)
+        return state
+
+    @property
+    def nbytes(self):
+        ''' Approximate memory held by the amplitudes, the dict with its index and amplitude objects.'''
+        entry = sys.getsizeof(1 << max(self.nq - 1, 0)) + sys.getsizeof(1j)
+        return sys.getsizeof(self.amps) + len(self.amps) * entry
+
+    def to_dense(self, dtype=complex, out=None):
+        ''' The state vector of the amplitudes, written into `out` (all zeros, e.g. a fresh memory map) if given.'''
+        psi = np.zeros(2**self.nq, dtype=dtype) if out is None else out
+        if out is not None:
+            psi[0] = 0
+        for index, amp in self.amps.items():
+            psi[index] = amp
+        return psi
+
+    """
+    ==========================================================================================================
+                                            Quantum Gates
+    ==========================================================================================================
+
+    """
+
+    def X(self, a):
+        bit = self.bit(a)
+        self.amps = {index ^ bit: amp for index, amp in self.amps.items()}
+
+    def Y(self, a):
+        bit = self.bit(a)
+        self.amps = {index ^ bit: amp * (-1j if index & bit else 1j) for index, amp in self.amps.items()}
+
+    def Z(self, a):
+        self.phase(self.bit(a), -1)
+
+    def S(self, a):
+        self.phase(self.bit(a), 1j)
+
+    def CNOT(self, control, target):
+        c, t = self.bit(control), self.bit(target)
+        self.amps = {(index ^ t if index & c else index): amp for index, amp in self.amps.items()}
+
+    def CZ(self, control, target):
+        self.phase(self.bit(control) | self.bit(target), -1)
+
+    def SWAP(self, a, b):
+        bit_a, bit_b = self.bit(a), self.bit(b)
+        self.amps = {(index ^ bit_a ^ bit_b if bool(index & bit_a) != bool(index & bit_b) else index): amp
+                     for index, amp in self.amps.items()}
+
+    def H(self, a):
+        self.U(np.array([[1, 1], [1, -1]]) / np.sqrt(2), a)
+
+    def U(self, matrix, a):
+        ''' Applies the 2x2 matrix to qubit a, dropping the amplitudes that interfere away.'''
+        bit = self.bit(a)
+        (u00, u01), (u10, u11) = matrix.tolist()
+        amps = {}
+        for index, amp in self.amps.items():
+            low = index & ~bit
+            if index & bit:
+                amps[low] = amps.get(low, 0) + u01 * amp
+                amps[index] = amps.get(index, 0) + u11 * amp
+            else:
+                amps[index] = amps.get(index, 0) + u00 * amp
+                amps[index | bit] = amps.get(index | bit, 0) + u10 * amp
+        self.amps = {index: amp for index, amp in amps.items() if abs(amp) > TOLERANCE}
+
+    def phase(self, mask, factor):
+        ''' Multiplies by factor the amplitudes of the basis states with all the bits of mask set.'''
+        self.amps = {index: (amp * factor if index & mask == mask else amp) for index, amp in self.amps.items()}
+
+    def expectation(self, x_mask, z_mask):
+        '''
+        Sum over the entries j of conj(amp[j ^ x_mask]) amp[j] (-1)^(bits of j & z_mask), the expectation value
+        of the Pauli string flipping x_mask and signing z_mask, short of its factor i^nY.
+        '''
+        total = 0j
+        for index, amp in self.amps.items():
+            partner = self.amps.get(index ^ x_mask)
+            if partner is not None:
+                total += partner.conjugate() * amp * (-1)**bin(index & z_mask).count('1')
+        return total
+
+    """
+    ==========================================================================================================
+                                            Measurement
+    ==========================================================================================================
+
+    """
+
+    def measure(self, a, sample):
+        '''
+        Measures qubit a in the computational basis. `sample` receives the outcome weights [p0, p1] and
+        returns the picked outcome; the outcome and its probability are returned.
+        '''
+        bit = self.bit(a)
+        weights = [0.0, 0.0]
+        for index, amp in self.amps.items():
+            weights[bool(index & bit)] += abs(amp)**2
+        pick = sample(weights)
+
+        scale = 1 / np.sqrt(weights[pick])
+        self.amps = {index: amp * scale for index, amp in self.amps.items() if bool(index & bit) == bool(pick)}
+        return pick, weights[pick]
@@ -0,0 +1,142 @@
+import numpy as np
+
+
+def _g(x1, z1, x2, z2):
+    ''' Power of i picked up when multiplying the single-qubit Paulis (x1, z1) and (x2, z2), elementwise.'''
+    x1, z1, x2, z2 = x1.view(np.int8), z1.view(np.int8), x2.view(np.int8), z2.view(np.int8)
+    return np.where(x1 & z1, z2 - x2, np.where(x1, z2 * (2*x2 - 1), np.where(z1, x2 * (1 - 2*z2), 0)))
+
+
+class StabilizerTableau():
+    """
+    Stabilizer tableau of an n-qubit state following Aaronson & Gottesman (CHP), for simulating Clifford
+    circuits in polynomial time.
+
+    The tableau has 2n rows: rows 0..n-1 are the destabilizers and rows n..2n-1 the stabilizers. The x and
+    z bits are stored qubit-major, i.e. x[a] is the column of qubit a over all rows, so every gate only
+    touches contiguous memory.
+    """
+
+    def __init__(self, nq: int):
+        self.nq = nq
+        self.x = np.zeros((nq, 2*nq), dtype=bool)
+        self.z = np.zeros((nq, 2*nq), dtype=bool)
+        self.r = np.zeros(2*nq, dtype=bool)
+
+        qubits = np.arange(nq)
+        self.x[qubits, qubits] = True # Destabilizers X_i
+        self.z[qubits, nq + qubits] = True # Stabilizers Z_i of |0...0>
+
+    """
+    ==========================================================================================================
+                                            Clifford Gates
+    ==========================================================================================================
+
+    """
+
+    def H(self, a):
+        self.r ^= self.x[a] & self.z[a]
+        self.x[a], self.z[a] = self.z[a].copy(), self.x[a].copy()
+
+    def S(self, a):
+        self.r ^= self.x[a] & self.z[a]
+        self.z[a] ^= self.x[a]
+
+    def X(self, a):
+        self.r ^= self.z[a]
+
+    def Y(self, a):
+        self.r ^= self.x[a] ^ self.z[a]
+
+    def Z(self, a):
+        self.r ^= self.x[a]
+
+    def CNOT(self, control, target):
+        self.r ^= self.x[control] & self.z[target] & ~(self.x[target] ^ self.z[control])
+        self.x[target] ^= self.x[control]
+        self.z[control] ^= self.z[target]
+
+    def CZ(self, control, target):
+        self.H(target)
+        self.CNOT(control, target)
+        self.H(target)
+
+    def SWAP(self, a, b):
+        self.x[[a, b]] = self.x[[b, a]]
+        self.z[[a, b]] = self.z[[b, a]]
+
+    """
+    ==========================================================================================================
+                                            Measurement
+    ==========================================================================================================
+
+    """
+
+    def rowsum(self, rows, i):
+        ''' Replaces every row h in `rows` by the Pauli product of rows h and i, tracking the phase.'''
+        g = _g(self.x[:, i, None], self.z[:, i, None], self.x[:, rows], self.z[:, rows])
+        phase = 2*self.r[rows].astype(int) + 2*int(self.r[i]) + g.sum(axis=0)
+
+        self.r[rows] = (phase % 4) == 2
+        self.x[:, rows] ^= self.x[:, i, None]
+        self.z[:, rows] ^= self.z[:, i, None]
+
+    def measure(self, a, sample):
+        '''
+        Measures qubit a in the computational basis. `sample` receives the outcome weights [p0, p1] and
+        returns the picked outcome; the outcome and its probability are returned.
+        '''
+        n = self.nq
+        stabilizers = np.flatnonzero(self.x[a, n:2*n])
+
+        if stabilizers.size:
+            # Random outcome: some stabilizer anticommutes with Z_a
+            p = n + stabilizers[0]
+            rows = np.flatnonzero(self.x[a, :2*n])
+            rows = rows[rows != p]
+            if rows.size:
+                self.rowsum(rows, p)
+
+            self.x[:, p - n], self.z[:, p - n], self.r[p - n] = self.x[:, p], self.z[:, p], self.r[p]
+            self.x[:, p] = False
+            self.z[:, p] = False
+            self.z[a, p] = True
+
+            pick = sample([0.5, 0.5])
+            self.r[p] = pick
+            return pick, 0.5
+
+        # Deterministic outcome: the sign of the product of the stabilizers generating Z_a
+        outcome = int(self.product_sign(n + np.flatnonzero(self.x[a, :n])) < 0)
+        weights = [1.0 - outcome, float(outcome)]
+        pick = sample(weights)
+        return pick, weights[pick]
+
+    def product_sign(self, rows):
+        '''
+        Sign (+1 or -1) of the product of the given commuting rows. The partial products are prefix XORs of the
+        rows, so the phases of all the steps are summed in one go.
+        '''
+        xs, zs = self.x[:, rows], self.z[:, rows]
+        prev_x, prev_z = np.zeros_like(xs), np.zeros_like(zs)
+        prev_x[:, 1:] = np.logical_xor.accumulate(xs, axis=1)[:, :-1]
+        prev_z[:, 1:] = np.logical_xor.accumulate(zs, axis=1)[:, :-1]
+        phase = 2*int(self.r[rows].sum()) + int(_g(xs, zs, prev_x, prev_z).sum())
+        return -1 if phase % 4 == 2 else 1
+
+    def anticommuting(self, flips, signs, rows):
+        ''' Mask of the rows anticommuting with the Pauli string having X on `flips` and Z on `signs` (Y on both).'''
+        flips, signs = list(flips), list(signs)
+        parity = self.z[flips][:, rows].sum(axis=0) + self.x[signs][:, rows].sum(axis=0)
+        return parity % 2 == 1
+
+    def expectation(self, flips, signs):
+        '''
+        Expectation value of the Pauli string having X on `flips` and Z on `signs` (Y on both): 0 if it anticommutes
+        with a stabilizer, else it is in the stabilizer group, the product of the stabilizers whose destabilizers
+        it anticommutes with, and the sign of that product is the value.
+        '''
+        n = self.nq
+        if self.anticommuting(flips, signs, slice(n, 2*n)).any():
+            return 0.0
+        return float(self.product_sign(n + np.flatnonzero(self.anticommuting(flips, signs, slice(0, n)))))
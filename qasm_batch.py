@@ -0,0 +1,205 @@
+import argparse
+import glob
+import json
+import os
+import signal
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+
+from QASM_oop import QASM_compiler, BACKENDS
+
+"""
+==========================================================================================================
+                                            Jobs
+==========================================================================================================
+
+"""
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def collect(inputs):
+    ''' The .qasm files of the given directories, glob patterns and files, in order and without duplicates.'''
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, '*.qasm')))
+        else:
+            matches = sorted(glob.glob(item)) or [item] # A missing file is reported as a failed job
+        files += [path for path in matches if path not in files]
+    return files
+
+
+def run_job(job):
+    '''
+    Compiles and runs one QASM file in a worker, returning its result as a dict. Any error or exceeding the
+    timeout (a SIGALRM from setitimer, checked between Python bytecodes) only fails this job, even when the
+    alarm fires while the job is finishing.
+    '''
+    index, path, options = job
+    result = {'index': index, 'file': path}
+    start = perf_counter()
+
+    try:
+        try:
+            if options['timeout']:
+                signal.signal(signal.SIGALRM, _alarm)
+                signal.setitimer(signal.ITIMER_REAL, options['timeout'])
+            circuit = QASM_compiler(path, backend=options['backend'], optimize=options['optimize'],
+                                    cache=options['cache'])
+            parsed = perf_counter()
+            shots = circuit.run_shots(options['shots'], seed=options['seed'])
+            done = perf_counter()
+
+            result.update({'status': 'ok', 'qubits': circuit.nq, 'operations': len(circuit.opcodes),
+                           'depth': circuit.depth(), 'shots': options['shots'], 'measured': shots['qubits'],
+                           'counts': shots['counts']})
+            if options['exact'] and circuit.nq <= options['exact_qubits']:
+                result['probabilities'] = circuit.exact_distribution()['distribution']
+            else:
+                result['probabilities'] = {bits: count / options['shots'] for bits, count in shots['counts'].items()}
+                if options['exact']: # The exact distribution evolves dense 2^n state vectors whatever the backend
+                    result['exact_skipped'] = f"{circuit.nq} qubits exceed --exact-qubits {options['exact_qubits']}"
+            result['timings'] = {'parse_s': parsed - start, 'shots_s': done - parsed}
+        finally:
+            # Still inside the outer try, so an alarm firing before it is disarmed is reported as a timeout;
+            # ignoring SIGALRM afterwards drops one that was delivered but not handled yet
+            if options['timeout']:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, signal.SIG_IGN)
+    except JobTimeout:
+        result = {'index': index, 'file': path, 'status': 'timeout',
+                  'error': f"Exceeded the timeout of {options['timeout']}s"}
+    except Exception as error:
+        result.update({'status': 'error', 'error': f'{type(error).__name__}: {error}'})
+
+    result.setdefault('timings', {})['total_s'] = perf_counter() - start
+    return result
+
+
+def plot(result, folder):
+    ''' Saves the histogram of the counts of a result as a PNG in folder, importing matplotlib only here.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots()
+    labels = sorted(result['counts'])
+    axes.bar(range(len(labels)), [result['counts'][bits] for bits in labels], tick_label=labels)
+    axes.set_title(os.path.basename(result['file']))
+    axes.set_ylabel('counts')
+    fig.savefig(os.path.join(folder, os.path.splitext(os.path.basename(result['file']))[0] + '.png'))
+    plt.close(fig)
+
+"""
+==========================================================================================================
+                                            Scheduling
+==========================================================================================================
+
+"""
+
+
+def run_all(files, options, workers: int):
+    '''
+    Yields the result of every file as soon as it is done, keeping at most 2 * workers jobs queued on the
+    process pool. A worker dying (e.g. killed for memory) breaks the pool: a fresh pool takes over, and the
+    jobs that were in flight are rerun one at a time so only the one that kills its worker is reported crashed.
+    '''
+    jobs = deque((index, path, options) for index, path in enumerate(files))
+    suspects = deque() # Jobs in flight when a worker died, not yet known to be innocent
+
+    while jobs or suspects:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending, lost = {}, []
+            while (jobs or suspects or pending) and not lost:
+                if suspects:
+                    if not pending:
+                        job = suspects.popleft()
+                        pending[pool.submit(run_job, job)] = job
+                else:
+                    while jobs and len(pending) < 2 * workers:
+                        job = jobs.popleft()
+                        pending[pool.submit(run_job, job)] = job
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        lost.append(job)
+                        continue
+                    except Exception as error: # E.g. a result that could not be sent back from the worker
+                        result = {'index': job[0], 'file': job[1], 'status': 'error',
+                                  'error': f'{type(error).__name__}: {error}'}
+                    yield result
+
+            lost += pending.values()
+            if len(lost) == 1:
+                index, path, _ = lost[0]
+                yield {'index': index, 'file': path, 'status': 'crashed',
+                       'error': "The worker process died while running this circuit"}
+            else:
+                suspects.extend(lost)
+
+"""
+==========================================================================================================
+                                            Command Line
+==========================================================================================================
+
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many QASM files concurrently, streaming one JSON result per line.")
+    parser.add_argument('inputs', nargs='+', help="Directories, glob patterns or .qasm files")
+    parser.add_argument('--shots', type=int, default=1000, help="Shots per circuit")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Size of the process pool")
+    parser.add_argument('--timeout', type=float, default=0, help="Seconds allowed per circuit, 0 for no limit")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the shots of every circuit")
+    parser.add_argument('--backend', choices=BACKENDS, default='statevector', help="Backend used for compiling and running the shots")
+    parser.add_argument('--optimize', action='store_true', help="Optimize the circuits before running them")
+    parser.add_argument('--exact', action='store_true',
+                        help="Report the exact outcome distribution as probabilities; it evolves dense state vectors, so "
+                             "wider circuits keep the shot frequencies and are marked 'exact_skipped'")
+    parser.add_argument('--exact-qubits', type=int, default=20, help="Widest circuit whose exact distribution is computed")
+    parser.add_argument('--cache', help="Directory of the compiled circuit cache shared by the workers")
+    parser.add_argument('--output', help="File for the JSON lines (standard output if not given)")
+    parser.add_argument('--plot', metavar='DIR', help="Save a histogram of the counts of every circuit in DIR")
+    args = parser.parse_args(argv)
+
+    files = collect(args.inputs)
+    options = {'shots': args.shots, 'timeout': args.timeout, 'seed': args.seed, 'backend': args.backend,
+               'optimize': args.optimize, 'exact': args.exact, 'exact_qubits': args.exact_qubits, 'cache': args.cache}
+    if args.plot:
+        os.makedirs(args.plot, exist_ok=True)
+
+    failures = 0
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for result in run_all(files, options, max(1, args.workers)):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            if result['status'] != 'ok':
+                failures += 1
+            elif args.plot:
+                plot(result, args.plot)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"✵ {len(files) - failures}/{len(files)} circuits succeeded", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
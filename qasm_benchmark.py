@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+
+from QASM_oop import QASM_compiler, BACKENDS, OPCODES, INTERNAL, ARITY
+
+"""
+==========================================================================================================
+                                            Random Circuits
+==========================================================================================================
+
+"""
+
+GATE_MIX = {'h': 3, 's': 1, 'x': 1, 'y': 1, 'z': 1, 'cnot': 3, 'cz': 1, 'nop': 0.5, 'c-x': 0.5, 'c-z': 0.5}
+
+
+def random_qasm(nq: int, depth: int, gate_mix=GATE_MIX, measure_density: float = 0.0, seed=None):
+    '''
+    Random QASM program in the dialect of parse_operations: `depth` operations on `nq` qubits drawn with the
+    weights of `gate_mix`, each one being a measurement instead with probability `measure_density`. The
+    c-x/c-z operations are only controlled by qubits measured before, and become measurements until one is.
+    '''
+    rng = random.Random(seed)
+    names, weights = list(gate_mix), list(gate_mix.values())
+    measured = []
+    lines = [f'\tqubit\tq{q}' for q in range(nq)] + ['']
+
+    for _ in range(depth):
+        name = 'measure' if rng.random() < measure_density else rng.choices(names, weights)[0]
+        if name in ('c-x', 'c-z') and not measured:
+            name = 'measure'
+
+        if name in ('c-x', 'c-z'):
+            control = rng.choice(measured)
+            target = rng.choice([q for q in range(nq) if q != control])
+            lines.append(f'\t{name}\tq{control},q{target}')
+        elif max(ARITY.get(name, (1,))) == 2:
+            control, target = rng.sample(range(nq), 2)
+            lines.append(f'\t{name}\tq{control},q{target}')
+        else:
+            qubit = rng.randrange(nq)
+            lines.append(f'\t{name}\tq{qubit}')
+            if name == 'measure' and qubit not in measured:
+                measured.append(qubit)
+
+    return '\n'.join(lines) + '\n'
+
+
+def parse_mix(text: str):
+    ''' Gate mix from a comma separated list of gate:weight pairs, e.g. "h:2,cnot:1,x:1".'''
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition(':')
+        name = name.strip()
+        if name not in OPCODES or name in INTERNAL or name == 'measure':
+            raise argparse.ArgumentTypeError(f"Unknown gate '{name}' in the gate mix (use --measure-density for measurements)")
+        mix[name] = float(weight or 1)
+    return mix
+
+"""
+==========================================================================================================
+                                            Timing
+==========================================================================================================
+
+"""
+
+
+def run_phases(filepath: str, backend: str, optimize: bool, shots: int, seed: int):
+    '''
+    Runs the three phases on a QASM file: parse (reading and compiling), simulate (circuit_simulate with the
+    mid-circuit measurements) and measure (sampling `shots` bitstrings from the final state vector, skipped
+    on a tableau). Returns the compiler and the wall time of every phase in seconds.
+    '''
+    times = {}
+
+    start = perf_counter()
+    circuit = QASM_compiler(filepath, backend=backend, optimize=optimize)
+    times['parse'] = perf_counter() - start
+
+    random.seed(seed)
+    start = perf_counter()
+    circuit.circuit_simulate()
+    times['simulate'] = perf_counter() - start
+
+    times['measure'] = None
+    if isinstance(circuit.current_state, np.ndarray):
+        start = perf_counter()
+        circuit.sample(shots, seed=seed)
+        times['measure'] = perf_counter() - start
+
+    return circuit, times
+
+
+def benchmark(filepath: str, backend: str, optimize: bool, shots: int, seed: int, repeat: int):
+    '''
+    Best wall time of every phase over `repeat` runs, then the peak traced memory of one more run, kept apart
+    so the tracing overhead does not leak into the timings.
+    '''
+    best = {}
+    for _ in range(repeat):
+        circuit, times = run_phases(filepath, backend, optimize, shots, seed)
+        for phase, elapsed in times.items():
+            if elapsed is not None:
+                best[phase] = min(best.get(phase, elapsed), elapsed)
+            else:
+                best[phase] = None
+
+    tracemalloc.start()
+    run_phases(filepath, backend, optimize, shots, seed)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'gates': len(circuit.opcodes), 'depth': circuit.depth(),
+            'parse_s': best['parse'], 'simulate_s': best['simulate'], 'measure_s': best['measure'],
+            'peak_bytes': peak}
+
+"""
+==========================================================================================================
+                                            Baseline Comparison
+==========================================================================================================
+
+"""
+
+PHASES = ('parse_s', 'simulate_s', 'measure_s', 'peak_bytes')
+
+
+def compare(results, baseline, tolerance: float, floor: float = 0.0):
+    '''
+    Ratios of every phase to the baseline run with the same backend, optimization and qubit count. A ratio
+    above `tolerance` is a regression, unless the phase took under `floor` seconds in both runs (timer noise);
+    returns the rows of the comparison and the regressions found.
+    '''
+    key = lambda row: (row['backend'], row['optimize'], row['qubits'])
+    reference = {key(row): row for row in baseline['results']}
+    rows, regressions = [], []
+
+    for row in results:
+        old = reference.get(key(row))
+        if old is None:
+            continue
+        for phase in PHASES:
+            if not row[phase] or not old.get(phase):
+                continue
+            ratio = row[phase] / old[phase]
+            noise = phase != 'peak_bytes' and max(row[phase], old[phase]) < floor
+            rows.append((*key(row), phase, old[phase], row[phase], ratio))
+            if ratio > tolerance and not noise:
+                regressions.append(rows[-1])
+
+    return rows, regressions
+
+"""
+==========================================================================================================
+                                            Command Line
+==========================================================================================================
+
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the QASM compiler on random circuits of growing size.")
+    parser.add_argument('--qubits', type=int, nargs='+', default=[2, 4, 8, 12, 16, 20], help="Qubit counts to sweep")
+    parser.add_argument('--depth', type=int, default=200, help="Operations per circuit")
+    parser.add_argument('--gate-mix', type=parse_mix, default=GATE_MIX, help="Gate weights, e.g. h:2,cnot:1,x:1")
+    parser.add_argument('--measure-density', type=float, default=0.05, help="Fraction of the operations that are measurements")
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=['statevector'], help="Backends to compare")
+    parser.add_argument('--optimize', action='store_true', help="Also run every backend on the optimized circuit")
+    parser.add_argument('--matrix-limit', type=int, default=10, help="Largest register run on the 'matrix' backend")
+    parser.add_argument('--shots', type=int, default=1000, help="Bitstrings sampled in the measure phase")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the best time is kept")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the circuits and of the measurements")
+    parser.add_argument('--output', help="JSON file for the results (printed if not given)")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.25, help="Slowdown ratio over the baseline counted as a regression")
+    parser.add_argument('--noise-floor', type=float, default=0.005, help="Phases faster than this (seconds) never count as regressions")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for nq in args.qubits:
+            # One circuit per qubit count, shared by all the backends so they are compared on the same work
+            filepath = os.path.join(folder, f'random_{nq}.qasm')
+            with open(filepath, 'w') as file:
+                file.write(random_qasm(nq, args.depth, args.gate_mix, args.measure_density, seed=args.seed + nq))
+
+            for backend in args.backends:
+                if backend == 'matrix' and nq > args.matrix_limit:
+                    continue
+                for optimize in (False, True) if args.optimize else (False,):
+                    row = {'qubits': nq, 'backend': backend, 'optimize': optimize}
+                    row.update(benchmark(filepath, backend, optimize, args.shots, args.seed, args.repeat))
+                    results.append(row)
+                    print(f"{backend:>11} {'optimized' if optimize else '':>9} {nq:>3} qubits: "
+                          f"parse {row['parse_s']:.4f}s, simulate {row['simulate_s']:.4f}s, "
+                          f"peak {row['peak_bytes'] / 2**20:.1f} MiB", file=sys.stderr)
+
+    report = {'config': {'depth': args.depth, 'gate_mix': args.gate_mix, 'measure_density': args.measure_density,
+                         'shots': args.shots, 'repeat': args.repeat, 'seed': args.seed},
+              'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'machine': platform.machine(), 'cpus': os.cpu_count()},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline['config'] != report['config']:
+            print("✵ Warning: the baseline was run with a different configuration", file=sys.stderr)
+
+        rows, regressions = compare(results, baseline, args.tolerance, args.noise_floor)
+        for row in rows:
+            backend, optimize, nq, phase, old, new, ratio = row
+            flag = '  << regression' if row in regressions else ''
+            print(f"{backend:>11} {'optimized' if optimize else '':>9} {nq:>3} qubits {phase:>10}: "
+                  f"{old:.4g} -> {new:.4g} ({ratio:.2f}x){flag}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
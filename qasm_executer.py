@@ -1,5 +1,4 @@
 from QASM_oop import QASM_compiler
-import matplotlib.pyplot as plt
 import numpy as np
 
 """
@@ -8,19 +7,21 @@ import numpy as np
 ==========================================================================================================
     
 """ 
-# circuit1 = QASM_compiler("QASM samples/test1.qasm")
-# circuit1 = QASM_compiler("QASM samples/test2.qasm")
-circuit1 = QASM_compiler("QASM samples/test3.qasm")
-# circuit1 = QASM_compiler("QASM samples/test4.qasm")
-# circuit1 = QASM_compiler("QASM samples/rep_code.qasm")
+# circuit1 = QASM_compiler("QASM samples/test1.qasm", history='full')
+# circuit1 = QASM_compiler("QASM samples/test2.qasm", history='full')
+circuit1 = QASM_compiler("QASM samples/test3.qasm", history='full')
+# circuit1 = QASM_compiler("QASM samples/test4.qasm", history='full')
+# circuit1 = QASM_compiler("QASM samples/rep_code.qasm", history='full')
 
 print("✵ The parsed quantum operations are: ",circuit1.read_circuit)
 print("✵ Number of qubits: ",circuit1.nq)
-print("✵ Total time steps for the hardware: ",circuit1.time)
+print("✵ Total operations of the circuit: ",circuit1.time)
+print("✵ Total time steps for the hardware (parallel moments): ",circuit1.depth())
 circuit1.circuit_simulate()
-print("✵ Final state at the end of the circuit is: ", circuit1.state[list(circuit1.state.keys())[-1]])
+print("✵ Final state at the end of the circuit is: ", circuit1.current_state)
 print("✵ The measurement probability distribution is: ", circuit1.probabilities)
 print("✵ The classical measuremeent for this run of the circuit is: ", circuit1.measurements)
+print("✵ The exact distribution of the measurement records is: ", circuit1.exact_distribution()['distribution'])
 print("✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵")
 print("✵ Chronological time evolution of the quantum circuit: \n", circuit1.state)
 print("✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵✵")
@@ -34,20 +35,14 @@ circuit1.visualize()
     
 """ 
 n = 500
-dist = np.zeros(circuit1.nq-1)
-qubits = list(circuit1.measurements.keys())
-print(qubits, dist)
+shots = circuit1.run_shots(n)
+qubits = shots['qubits']
+dist = shots['records'].mean(axis=0) # Fraction of the shots in which each measurement gave 1
+print("✵ Measurement counts over %d shots: " % n, shots['counts'])
 
-for itr in list(range(n)):
-    circuit1.circuit_simulate()
-    i = 0
-    for key, value in circuit1.measurements:
-        dist[i] = dist[i] + int(value)
-        i += 1
-
-dist = dist / n
+import matplotlib.pyplot as plt # Only needed for plotting, see qasm_batch.py for headless runs
 
 fig, axes = plt.subplots()
 
-axes.bar(qubits, dist)
+axes.bar(range(len(qubits)), dist, tick_label=qubits)
 plt.show()
\ No newline at end of file
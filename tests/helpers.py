@@ -0,0 +1,27 @@
+import os
+
+from qasm_benchmark import random_qasm
+
+CLIFFORD_MIX = {'h': 3, 's': 2, 'x': 1, 'y': 1, 'z': 1, 'cnot': 3, 'cz': 2, 'c-x': 0.5, 'c-z': 0.5}
+
+
+def write_qasm(folder, name, qasm):
+    ''' Writes a QASM program to the file name in folder, returning its path.'''
+    path = os.path.join(folder, name)
+    with open(path, 'w') as file:
+        file.write(qasm)
+    return path
+
+
+def write_circuit(folder, name, nq, depth, gate_mix, measure_density, seed):
+    ''' Random circuit with every qubit measured at the end, written to a .qasm file in folder.'''
+    qasm = random_qasm(nq, depth, gate_mix, measure_density, seed=seed)
+    qasm += ''.join(f'\tmeasure\tq{q}\n' for q in range(nq))
+    return write_qasm(folder, name, qasm)
+
+
+def total_variation(counts, distribution):
+    ''' Total variation distance between the frequencies of shot counts and a distribution of bitstrings.'''
+    shots = sum(counts.values())
+    keys = set(counts) | set(distribution)
+    return sum(abs(counts.get(key, 0) / shots - distribution.get(key, 0.0)) for key in keys) / 2
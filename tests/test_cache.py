@@ -0,0 +1,32 @@
+import time
+
+import numpy as np
+
+from QASM_oop import QASM_compiler
+from QASM_cache import CircuitCache
+from helpers import CLIFFORD_MIX, write_circuit
+
+
+def test_cache_evicts_the_least_recently_used_entries(tmp_path):
+    cache = CircuitCache(str(tmp_path), max_bytes=10**9)
+    for name in ('a', 'b', 'c'):
+        cache.put(name, data=np.zeros(1000))
+        time.sleep(0.01) # Distinct modification times
+    assert cache.get('a') is not None # Now the most recently used
+
+    cache.max_bytes = cache.size() - 1
+    cache.evict()
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_cached_circuit_equals_the_compiled_one(tmp_path):
+    path = write_circuit(tmp_path, 'random.qasm', 4, 60, CLIFFORD_MIX, 0.1, 2)
+    cache = CircuitCache(str(tmp_path / 'cache'))
+    compiled = QASM_compiler(path, optimize=True, cache=cache)
+    cached = QASM_compiler(path, optimize=True, cache=cache)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cached.nq == compiled.nq and cached.time == compiled.time
+    assert cached.program() == compiled.program()
+    assert cached.exact_distribution()['distribution'] == compiled.exact_distribution()['distribution']
@@ -0,0 +1,81 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler, OPCODE
+
+PAULI = {'I': np.eye(2), 'X': np.array([[0, 1], [1, 0]]), 'Y': np.array([[0, -1j], [1j, 0]]),
+         'Z': np.diag([1, -1])}
+CLIFFORD = ['h', 's', 'x', 'y', 'z', 'cnot', 'cz', 'swap']
+
+
+def dense_expectation(psi, pauli):
+    ''' <psi|P|psi> with the operator of the dense Pauli string built by kron, qubit 0 first.'''
+    operator = np.array([[1]])
+    for letter in pauli:
+        operator = np.kron(operator, PAULI[letter])
+    return (psi.conj() @ operator @ psi).real
+
+
+def random_program(nq, depth, rng, gates):
+    program = []
+    for _ in range(depth):
+        name = rng.choice(gates)
+        if name in ('cnot', 'cz', 'swap'):
+            program.append([OPCODE[name], *rng.sample(range(nq), 2)])
+        else:
+            program.append([OPCODE[name], rng.randrange(2) if name == 'u' else -1, rng.randrange(nq)])
+    return program
+
+
+def run(nq, program, unitaries=(), seed=0, **options):
+    circuit = QASM_compiler.from_program(nq, program, unitaries, **options)
+    random.seed(seed)
+    circuit.circuit_simulate()
+    return circuit
+
+
+def all_paulis(nq):
+    return [''.join(letters) for letters in itertools.product('IXYZ', repeat=nq)]
+
+
+@pytest.fixture
+def generic_program():
+    rng = np.random.default_rng(2)
+    unitaries = [np.linalg.qr(rng.normal(size=(2, 2)) + 1j * rng.normal(size=(2, 2)))[0] for _ in range(2)]
+    return random_program(3, 30, random.Random(2), CLIFFORD + ['u', 'u']), unitaries
+
+
+@pytest.mark.parametrize('options', [{}, {'backend': 'sparse'}, {'out_of_core': True, 'memory_budget': 256},
+                                     {'backend': 'sparse', 'out_of_core': True, 'memory_budget': 256}])
+def test_expectations_equal_the_dense_operator(generic_program, options):
+    program, unitaries = generic_program
+    psi = run(3, program, unitaries).state_vector()
+    circuit = run(3, program, unitaries, **options)
+
+    paulis = all_paulis(3)
+    assert np.allclose(circuit.expectations(paulis), [dense_expectation(psi, p) for p in paulis])
+
+
+def test_pauli_strings_by_qubit_label(generic_program):
+    program, unitaries = generic_program
+    circuit = run(3, program, unitaries)
+    psi = circuit.state_vector()
+
+    assert np.isclose(circuit.expectation('X0 Z2'), dense_expectation(psi, 'XIZ'))
+    assert np.isclose(circuit.expectation('Y2*X1'), dense_expectation(psi, 'IXY'))
+    with pytest.raises(ValueError):
+        circuit.expectation('X3')
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_tableau_expectations_equal_the_dense_operator(seed):
+    nq = random.Random(seed).randint(1, 4)
+    program = random_program(nq, 40, random.Random(seed), CLIFFORD + ['measure'] if nq > 1 else ['h', 's', 'measure'])
+    psi = run(nq, program, seed=seed).state_vector()
+    tableau = run(nq, program, seed=seed, backend='tableau')
+
+    paulis = all_paulis(nq)
+    assert np.allclose(tableau.expectations(paulis), [dense_expectation(psi, p) for p in paulis])
@@ -0,0 +1,54 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler
+from qasm_benchmark import random_qasm
+from helpers import write_qasm
+
+
+@pytest.fixture
+def circuit_file(tmp_path):
+    return write_qasm(tmp_path, 'random.qasm', random_qasm(5, 90, measure_density=0.1, seed=4))
+
+
+def run(path, seed=3, **options):
+    circuit = QASM_compiler(path, **options)
+    random.seed(seed)
+    circuit.circuit_simulate()
+    return circuit
+
+
+@pytest.mark.parametrize('options', [{'history': 'checkpoint', 'checkpoint_every': 1},
+                                     {'history': 'checkpoint', 'checkpoint_every': 7},
+                                     {'history': 'checkpoint', 'checkpoint_every': 1000},
+                                     {'history': 'disk'}])
+def test_state_at_replays_the_full_history(circuit_file, options):
+    full = run(circuit_file, history='full')
+    kept = run(circuit_file, **options)
+
+    assert kept.measurements == full.measurements
+    for t in range(-1, full.time):
+        assert np.allclose(kept.state_at(t), full.state_at(t))
+
+
+def test_disk_history_keeps_a_given_file(circuit_file, tmp_path):
+    history_file = str(tmp_path / 'history.state')
+    circuit = run(circuit_file, history='disk', history_file=history_file)
+    assert (tmp_path / 'history.state').stat().st_size == (circuit.time + 1) * 2**circuit.nq * 16
+
+
+def test_history_none_keeps_only_the_current_state(circuit_file):
+    circuit = run(circuit_file)
+    assert list(circuit.state) == [f't{circuit.time - 1}']
+    with pytest.raises(KeyError):
+        circuit.state_at(0)
+
+
+@pytest.mark.parametrize('options', [{'backend': 'tableau', 'history': 'full'},
+                                     {'backend': 'tableau', 'history': 'disk'},
+                                     {'history': 'checkpoint', 'checkpoint_every': 0}])
+def test_invalid_history_options_raise(circuit_file, options):
+    with pytest.raises(ValueError):
+        QASM_compiler(circuit_file, **options)
@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler, KERNELS, OPCODE, new_scratch
+
+
+def random_program(nq, depth, rng):
+    ''' Random compiled program using every opcode, with 'u' drawing from two random unitaries.'''
+    program, measured = [], []
+    for _ in range(depth):
+        name = rng.choice(['h', 's', 'x', 'y', 'z', 'u', 'nop', 'cnot', 'cz', 'swap', 'measure', 'c-x', 'c-z'])
+        if name in ('c-x', 'c-z') and not measured:
+            name = 'measure'
+        if name in ('cnot', 'cz', 'swap'):
+            program.append([OPCODE[name], *rng.sample(range(nq), 2)])
+        elif name in ('c-x', 'c-z'):
+            control = rng.choice(measured)
+            program.append([OPCODE[name], control, rng.choice([q for q in range(nq) if q != control])])
+        elif name == 'nop':
+            program.append([OPCODE[name], -1, -1])
+        else:
+            qubit = rng.randrange(nq)
+            program.append([OPCODE[name], rng.randrange(2) if name == 'u' else -1, qubit])
+            if name == 'measure':
+                measured.append(qubit)
+    return program
+
+
+def random_unitary(rng):
+    matrix = rng.normal(size=(2, 2)) + 1j * rng.normal(size=(2, 2))
+    return np.linalg.qr(matrix)[0]
+
+
+@pytest.mark.parametrize('seed', range(6))
+def test_in_place_kernels_equal_the_matrix_backend(seed):
+    rng = random.Random(seed)
+    nq = rng.randint(2, 5)
+    program = random_program(nq, 60, rng)
+    unitaries = [random_unitary(np.random.default_rng(seed + k)) for k in range(2)]
+
+    runs = []
+    for backend in ('statevector', 'matrix'):
+        circuit = QASM_compiler.from_program(nq, program, unitaries, backend=backend, history='full')
+        random.seed(seed)
+        circuit.circuit_simulate()
+        runs.append(circuit)
+
+    statevector, matrix = runs
+    assert statevector.measurements == matrix.measurements
+    for t in range(-1, len(program)):
+        assert np.allclose(statevector.state_at(t), matrix.state_at(t))
+
+
+@pytest.mark.parametrize('name', ['h', 's', 'x', 'y', 'z', 'cnot', 'cz', 'swap'])
+def test_kernels_act_on_every_state_of_a_batch(name):
+    nq = 4
+    rng = np.random.default_rng(1)
+    batch = rng.normal(size=(2, 3, 2**nq)) + 1j * rng.normal(size=(2, 3, 2**nq))
+    control, target = (2, 0) if name in ('cnot', 'cz', 'swap') else (-1, 1)
+
+    expected = batch.copy()
+    for row in np.ndindex(batch.shape[:-1]):
+        KERNELS[OPCODE[name]](expected[row], nq, control, target, new_scratch())
+    KERNELS[OPCODE[name]](batch, nq, control, target, new_scratch(size=4)) # Scratch smaller than the views
+    assert np.allclose(batch, expected)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler
+from helpers import CLIFFORD_MIX, write_circuit
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_optimize_keeps_the_exact_distribution(tmp_path, seed):
+    path = write_circuit(tmp_path, 'random.qasm', 4, 60, CLIFFORD_MIX, 0.05, seed)
+    plain = QASM_compiler(path).exact_distribution()
+    optimized = QASM_compiler(path, optimize=True).exact_distribution()
+
+    assert plain['qubits'] == optimized['qubits']
+    keys = set(plain['distribution']) | set(optimized['distribution'])
+    for key in keys:
+        assert optimized['distribution'].get(key, 0.0) == pytest.approx(plain['distribution'].get(key, 0.0), abs=1e-9)
+
+
+def test_optimize_reports_every_pass_without_adding_gates(tmp_path):
+    path = write_circuit(tmp_path, 'random.qasm', 4, 120, CLIFFORD_MIX, 0.05, 9)
+    plain = QASM_compiler(path)
+    optimized = QASM_compiler(path, optimize=True)
+
+    report = optimized.optimization_report
+    assert report[0]['gates_before'] == len(plain.opcodes)
+    assert report[-1]['gates_after'] == len(optimized.opcodes) <= len(plain.opcodes)
+    for before, after in zip(report, report[1:]):
+        assert after['gates_before'] == before['gates_after']
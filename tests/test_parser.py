@@ -0,0 +1,41 @@
+import pytest
+
+from QASM_oop import QASM_compiler, OPCODE, parse_line
+from helpers import write_qasm
+
+WIDE = ''.join(f'\tqubit\tq{q}\n' for q in range(12)) + '''
+\th\tq10\t# comment after an operation
+\tcnot\tq10,q11
+\tcz\tq1,q10
+\tnop
+\tmeasure\tq11
+\tc-x\tq11,q3
+'''
+
+
+def test_labels_of_two_digits_parse(tmp_path):
+    circuit = QASM_compiler(write_qasm(tmp_path, 'wide.qasm', WIDE))
+
+    assert circuit.nq == 12 and circuit.time == 6
+    assert circuit.program() == [(0, OPCODE['h'], -1, 10), (1, OPCODE['cnot'], 10, 11), (2, OPCODE['cz'], 1, 10),
+                                 (3, OPCODE['nop'], -1, -1), (4, OPCODE['measure'], -1, 11),
+                                 (5, OPCODE['c-x'], 11, 3)]
+
+
+def test_parse_line_keeps_operation_and_labels():
+    assert parse_line('\tcnot\tq10,q2\t# comment') == ['cnot', '10,2']
+    assert parse_line('   # only a comment') is None
+    assert parse_line('\tnop') == ['nop', 'nop']
+
+
+@pytest.mark.parametrize('line, message', [
+    ('\tfoo\tq0', "Unknown operation 'foo'"),
+    ('\th\tq12', "Qubit out of range"),
+    ('\tcnot\tq3,q3', "coincide"),
+    ('\tcnot\tq3', "Wrong number of qubits"),
+    ('\th\tqa', "Invalid qubit labels"),
+])
+def test_invalid_operations_raise(tmp_path, line, message):
+    path = write_qasm(tmp_path, 'bad.qasm', ''.join(f'\tqubit\tq{q}\n' for q in range(12)) + '\n' + line + '\n')
+    with pytest.raises(ValueError, match=message):
+        QASM_compiler(path)
@@ -0,0 +1,75 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler, OPCODE, marginal
+
+QUBITS = [[2, 0], [0, 2], [3, 1, 4], [4, 3, 2, 1, 0], [1]]
+
+
+def brute_force_marginal(psi, nq, qubits):
+    ''' Adds |amplitude|^2 of every basis state to the outcome of `qubits` it contains, qubit 0 being the MSB.'''
+    result = np.zeros(2**len(qubits))
+    for index, amplitude in enumerate(psi):
+        outcome = 0
+        for q in qubits:
+            outcome = 2*outcome + ((index >> (nq - 1 - q)) & 1)
+        result[outcome] += abs(amplitude)**2
+    return result
+
+
+def run(**options):
+    ''' Five qubits rotated by different unitaries and entangled, so that no two marginals coincide.'''
+    rng = np.random.default_rng(8)
+    unitaries = [np.linalg.qr(rng.normal(size=(2, 2)) + 1j * rng.normal(size=(2, 2)))[0] for _ in range(5)]
+    program = [[OPCODE['u'], q, q] for q in range(5)] + [[OPCODE['cnot'], 1, 3], [OPCODE['measure'], -1, 4],
+                                                          [OPCODE['u'], 0, 2], [OPCODE['cz'], 2, 0]]
+    circuit = QASM_compiler.from_program(5, program, unitaries, **options)
+    random.seed(5)
+    circuit.circuit_simulate()
+    return circuit
+
+
+@pytest.mark.parametrize('qubits', QUBITS)
+def test_marginal_follows_the_order_of_the_qubits(qubits):
+    circuit = run()
+    psi = circuit.state_vector()
+    assert np.allclose(circuit.marginal_probabilities(qubits), brute_force_marginal(psi, 5, qubits))
+
+
+@pytest.mark.parametrize('qubits', QUBITS)
+@pytest.mark.parametrize('block', [1, 4, 8, 32, 1000])
+def test_blocked_marginal_equals_the_in_memory_one(qubits, block):
+    rng = np.random.default_rng(block)
+    psi = rng.normal(size=32) + 1j * rng.normal(size=32)
+    assert np.allclose(marginal(psi, 5, qubits, block), marginal(psi, 5, qubits))
+
+
+def test_out_of_core_marginal_equals_the_in_memory_one():
+    in_memory = run()
+    out_of_core = run(out_of_core=True, memory_budget=256)
+    for qubits in QUBITS:
+        assert np.allclose(out_of_core.marginal_probabilities(qubits), in_memory.marginal_probabilities(qubits))
+
+
+@pytest.mark.parametrize('qubits', [[5], [-1], [0, 0]])
+def test_invalid_qubits_raise(qubits):
+    circuit = run()
+    with pytest.raises(ValueError):
+        circuit.marginal_probabilities(qubits)
+
+
+def test_sample_records_match_the_counts():
+    circuit = run()
+    result = circuit.sample(4000, qubits=[3, 0], seed=1)
+
+    assert result['qubits'] == ['q3', 'q0'] and result['records'].shape == (4000, 2)
+    rows, frequency = np.unique(result['records'], axis=0, return_counts=True)
+    assert {''.join(map(str, row)): int(n) for row, n in zip(rows, frequency)} == result['counts']
+
+    probs = circuit.marginal_probabilities([3, 0])
+    for outcome, n in result['counts'].items():
+        assert probs[int(outcome, 2)] > 0
+        assert abs(n / 4000 - probs[int(outcome, 2)]) < 0.05
+    assert circuit.sample(4000, qubits=[3, 0], seed=1)['counts'] == result['counts']
@@ -0,0 +1,16 @@
+import numpy as np
+
+from QASM_oop import QASM_compiler
+from helpers import CLIFFORD_MIX, write_circuit
+
+
+def test_run_shots_records_do_not_depend_on_workers(tmp_path):
+    path = write_circuit(tmp_path, 'random.qasm', 5, 80, CLIFFORD_MIX, 0.1, 3)
+    circuit = QASM_compiler(path)
+    serial = circuit.run_shots(1000, seed=11, workers=1, chunk_size=128)
+    parallel = circuit.run_shots(1000, seed=11, workers=2, chunk_size=128)
+
+    assert serial['qubits'] == parallel['qubits']
+    assert serial['records'].dtype == parallel['records'].dtype
+    assert np.array_equal(serial['records'], parallel['records'])
+    assert serial['counts'] == parallel['counts']
@@ -0,0 +1,41 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler
+from qasm_benchmark import random_qasm
+from helpers import CLIFFORD_MIX, write_circuit, write_qasm, total_variation
+
+
+def test_sparse_matches_statevector_statistics(tmp_path):
+    path = write_circuit(tmp_path, 'random.qasm', 4, 40, CLIFFORD_MIX, 0.05, 7)
+    exact = QASM_compiler(path).exact_distribution()['distribution']
+    shots = QASM_compiler(path, backend='sparse').run_shots(2000, seed=7)
+    assert total_variation(shots['counts'], exact) < 0.08
+
+
+@pytest.mark.parametrize('sparse_fill', [1/16, 1.0])
+def test_sparse_state_equals_the_state_vector(tmp_path, sparse_fill):
+    # A fill of 1/16 switches to the dense vector early in the run, 1.0 never does
+    path = write_qasm(tmp_path, 'random.qasm', random_qasm(6, 80, measure_density=0.05, seed=5))
+    dense = QASM_compiler(path)
+    random.seed(2)
+    dense.circuit_simulate()
+    sparse = QASM_compiler(path, backend='sparse', sparse_fill=sparse_fill)
+    random.seed(2)
+    sparse.circuit_simulate()
+
+    assert sparse.measurements == dense.measurements
+    assert np.allclose(sparse.state_vector(), dense.current_state)
+
+
+def test_sparse_runs_registers_beyond_float_range(tmp_path):
+    nq = 1100
+    qasm = ''.join(f'\tqubit\tq{q}\n' for q in range(nq)) + '\n\th\tq0\n'
+    qasm += ''.join(f'\tcnot\tq0,q{q}\n' for q in range(1, nq)) + f'\tmeasure\tq0\n\tmeasure\tq{nq - 1}\n'
+    circuit = QASM_compiler(write_qasm(tmp_path, 'ghz.qasm', qasm), backend='sparse')
+
+    shots = circuit.run_shots(20, seed=1)
+    assert set(shots['counts']) <= {'00', '11'}
+    assert len(circuit.current_state.amps) == 1
@@ -0,0 +1,101 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler
+from QASM_stabilizer import StabilizerTableau
+from helpers import CLIFFORD_MIX, write_circuit, total_variation
+
+PAULIS = {(0, 0): np.eye(2), (1, 0): np.array([[0, 1], [1, 0]]), (0, 1): np.diag([1, -1]),
+          (1, 1): np.array([[0, -1j], [1j, 0]])}
+SINGLE = {'H': np.array([[1, 1], [1, -1]]) / np.sqrt(2), 'S': np.diag([1, 1j]), 'X': PAULIS[1, 0],
+          'Y': PAULIS[1, 1], 'Z': PAULIS[0, 1]}
+
+
+def apply(psi, matrix, qubit):
+    ''' Applies a 2x2 matrix to qubit of the (2,)*n state tensor psi, qubit 0 being its first axis.'''
+    return np.moveaxis(np.tensordot(matrix, psi, axes=([1], [qubit])), 0, qubit)
+
+
+def controlled(psi, matrix, control, target):
+    psi = psi.copy()
+    index = [slice(None)] * psi.ndim
+    index[control] = 1
+    target_axis = target - (target > control) # The control axis is dropped by the indexing
+    psi[tuple(index)] = apply(psi[tuple(index)], matrix, target_axis)
+    return psi
+
+
+def stabilizer_operator(tableau, row):
+    ''' Dense matrix of the signed Pauli string of a row of the tableau.'''
+    operator = np.array([[-1.0 if tableau.r[row] else 1.0]])
+    for qubit in range(tableau.nq):
+        operator = np.kron(operator, PAULIS[int(tableau.x[qubit, row]), int(tableau.z[qubit, row])])
+    return operator
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_tableau_runs_in_lockstep_with_the_state_vector(seed):
+    '''
+    Random Clifford circuits with many mid-circuit measurements: every measurement weight returned by the
+    tableau must be the probability of the state vector, and every signed stabilizer must fix the final state.
+    '''
+    rng = random.Random(seed)
+    for trial in range(150):
+        nq = rng.randint(2, 5)
+        tableau = StabilizerTableau(nq)
+        psi = np.zeros((2,) * nq, dtype=complex)
+        psi[(0,) * nq] = 1
+
+        for _ in range(rng.randint(1, 40)):
+            kind = rng.random()
+            if kind < 0.45:
+                name, qubit = rng.choice('HSXYZ'), rng.randrange(nq)
+                getattr(tableau, name)(qubit)
+                psi = apply(psi, SINGLE[name], qubit)
+            elif kind < 0.75:
+                control, target = rng.sample(range(nq), 2)
+                if rng.random() < 0.5:
+                    tableau.CNOT(control, target)
+                    psi = controlled(psi, SINGLE['X'], control, target)
+                else:
+                    tableau.CZ(control, target)
+                    psi = controlled(psi, SINGLE['Z'], control, target)
+            else:
+                qubit = rng.randrange(nq)
+                pick, weight = tableau.measure(qubit, lambda weights: rng.choices([0, 1], weights)[0])
+                prob = np.sum(np.abs(np.take(psi, pick, axis=qubit))**2)
+                assert weight == pytest.approx(prob, abs=1e-9)
+
+                keep = np.zeros(2)
+                keep[pick] = 1 / np.sqrt(prob)
+                psi = apply(psi, np.diag(keep), qubit)
+
+        vector = psi.reshape(-1)
+        for row in range(nq, 2 * nq):
+            assert np.allclose(stabilizer_operator(tableau, row) @ vector, vector)
+
+
+def test_deterministic_measurement_sums_the_product_phases():
+    # (|000> + |101>)/sqrt(2) built so that Z1 is a product of stabilizers whose partial products pick up
+    # a phase of -1, which the sign of the outcome must include
+    tableau = StabilizerTableau(3)
+    tableau.CNOT(2, 0)
+    tableau.H(2)
+    tableau.CNOT(0, 1)
+    tableau.CNOT(2, 0)
+    assert tableau.measure(1, lambda weights: weights.index(max(weights))) == (0, 1.0)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_tableau_matches_statevector_statistics(tmp_path, seed):
+    # Shallow circuits rich in h and s, whose outcomes are often deterministic, so phase errors of the tableau show
+    mix = dict(CLIFFORD_MIX, h=4, s=4)
+    path = write_circuit(tmp_path, 'clifford.qasm', 3, 12, mix, 0.05, seed)
+    exact = QASM_compiler(path).exact_distribution()['distribution']
+    circuit = QASM_compiler(path, backend='tableau')
+    assert circuit.is_clifford()
+
+    shots = circuit.run_shots(500, seed=seed)
+    assert total_variation(shots['counts'], exact) < 0.1
@@ -0,0 +1,38 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler
+from qasm_benchmark import random_qasm
+from helpers import write_qasm
+
+
+def run(path, seed, **options):
+    circuit = QASM_compiler(path, **options)
+    random.seed(seed)
+    circuit.circuit_simulate()
+    return circuit
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_streamed_run_equals_the_compiled_run(tmp_path, seed):
+    path = write_qasm(tmp_path, 'random.qasm', random_qasm(3 + seed, 80, measure_density=0.1, seed=seed))
+    compiled = run(path, seed)
+    streamed = QASM_compiler(path, stream=True)
+    assert streamed.nq == streamed.time == 0 # Nothing is read before the run
+
+    random.seed(seed)
+    streamed.circuit_simulate()
+    assert (streamed.nq, streamed.time) == (compiled.nq, compiled.time)
+    assert streamed.measurements == compiled.measurements
+    assert np.allclose(streamed.state_vector(), compiled.state_vector())
+    assert np.allclose(streamed.marginal_probabilities([1, 0]), compiled.marginal_probabilities([1, 0]))
+
+
+@pytest.mark.parametrize('method, args', [('program', ()), ('depth', ()), ('is_clifford', ()),
+                                          ('circuit_unitary', ()), ('exact_distribution', ()), ('run_shots', (4,))])
+def test_whole_program_methods_raise_when_streamed(tmp_path, method, args):
+    circuit = run(write_qasm(tmp_path, 'random.qasm', random_qasm(3, 20, seed=0)), 0, stream=True)
+    with pytest.raises(ValueError):
+        getattr(circuit, method)(*args)
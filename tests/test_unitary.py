@@ -0,0 +1,84 @@
+import random
+
+import numpy as np
+import pytest
+
+from QASM_oop import QASM_compiler, OPCODE
+
+GATES = ['h', 's', 'x', 'y', 'z', 'u', 'cnot', 'cz', 'swap']
+
+
+def random_program(nq, depth, rng, measure=False):
+    ''' Random compiled program of the unitary gates, plus measure and c-x/c-z with `measure`.'''
+    program, measured = [], []
+    for _ in range(depth):
+        name = rng.choice(GATES + ['measure', 'c-x', 'c-z'] if measure else GATES)
+        if name in ('c-x', 'c-z') and not measured:
+            name = 'measure'
+        if name in ('cnot', 'cz', 'swap'):
+            program.append([OPCODE[name], *rng.sample(range(nq), 2)])
+        elif name in ('c-x', 'c-z'):
+            control = rng.choice(measured)
+            program.append([OPCODE[name], control, rng.choice([q for q in range(nq) if q != control])])
+        else:
+            qubit = rng.randrange(nq)
+            program.append([OPCODE[name], rng.randrange(2) if name == 'u' else -1, qubit])
+            if name == 'measure':
+                measured.append(qubit)
+    return program
+
+
+def random_unitaries(seed):
+    rng = np.random.default_rng(seed)
+    return [np.linalg.qr(rng.normal(size=(2, 2)) + 1j * rng.normal(size=(2, 2)))[0] for _ in range(2)]
+
+
+def gate_by_gate(nq, program, unitaries, basis):
+    ''' Final state of the program run gate by gate from the basis state |basis>, prepared with x gates.'''
+    prepare = [[OPCODE['x'], -1, q] for q in range(nq) if (basis >> (nq - 1 - q)) & 1]
+    circuit = QASM_compiler.from_program(nq, prepare + program, unitaries)
+    circuit.circuit_simulate()
+    return circuit.state_vector()
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_circuit_unitary_columns_equal_gate_by_gate_runs(seed):
+    rng = random.Random(seed)
+    nq = rng.randint(1, 4)
+    program = random_program(nq, 40, rng) if nq > 1 else [[OPCODE['h'], -1, 0], [OPCODE['u'], 1, 0]]
+    unitaries = random_unitaries(seed)
+    unitary = QASM_compiler.from_program(nq, program, unitaries).circuit_unitary()
+
+    assert np.allclose(unitary.conj().T @ unitary, np.eye(2**nq))
+    for basis in range(2**nq):
+        assert np.allclose(unitary[:, basis], gate_by_gate(nq, program, unitaries, basis))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_evolve_applies_the_circuit_unitary(seed):
+    rng = random.Random(seed)
+    program = random_program(3, 40, rng)
+    circuit = QASM_compiler.from_program(3, program, random_unitaries(seed))
+    states = np.random.default_rng(seed).normal(size=(8, 5)) + 1j * np.random.default_rng(seed + 1).normal(size=(8, 5))
+    states /= np.linalg.norm(states, axis=0)
+
+    result = circuit.evolve(states)
+    assert np.allclose(result['states'], circuit.circuit_unitary() @ states)
+    assert result['qubits'] == [] and result['records'].shape == (5, 0)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_evolve_with_measurements_equals_the_unfused_batch(seed):
+    rng = random.Random(seed)
+    program = random_program(3, 50, rng, measure=True)
+    circuit = QASM_compiler.from_program(3, program, random_unitaries(seed))
+    states = np.random.default_rng(seed).normal(size=(8, 6)) + 1j * np.random.default_rng(seed + 1).normal(size=(8, 6))
+    states /= np.linalg.norm(states, axis=0)
+
+    result = circuit.evolve(states, seed=seed)
+    psi = np.array(states.T, order='C')
+    records = circuit.run_batch(6, np.random.default_rng(seed), psi=psi, fused=False)
+    assert np.array_equal(result['records'], records)
+    assert np.allclose(result['states'], psi.T)
+    with pytest.raises(ValueError):
+        circuit.circuit_unitary()